@@ -1,12 +1,17 @@
 import datetime
+import functools
 import html
 import io
+import os
+import shutil
+import threading
+import time
 from typing import Any
 from pathlib import Path
-from fastapi import APIRouter, HTTPException, Response, Header, Query
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Header, Query
+from fastapi.responses import StreamingResponse, FileResponse
 from .common_stream import Stream, MergeStream, CatStream
-from .compr_stream import auto_compress_stream, stream_ext
+from .compr_stream import auto_compress_stream, stream_ext, FileReadStream
 from logging import getLogger
 
 router = APIRouter()
@@ -17,31 +22,39 @@ api_config: dict[str, Any] = {
         6: "lightcyan",    # sun
     },
     "today_color": "yellow",
+    "list_ttl": 5,
 }
 exts = set(stream_ext.keys())
+list_exts = exts | {".log", ".txt"}
+passthrough_encodings = (("br", ".br"), ("gzip", ".gz"))
+_ldir_cache: dict[tuple[str, str, int], tuple[float, dict[str, dict[str, str]]]] = {}
+_ldir_cache_size = 256
+# sync endpoints run in threadpool
+_ldir_cache_lock = threading.Lock()
+_working_dir_resolved = Path(".").resolve()
 month_query = Query(pattern='(^[0-9]{4}|^$)', default="")
 
 
 def update_config(conf: dict):
-    global api_config
+    global api_config, _working_dir_resolved
     api_config.update(conf)
+    _working_dir_resolved = Path(api_config.get("working_dir", ".")).resolve()
+    with _ldir_cache_lock:
+        _ldir_cache.clear()
 
 
 def uri2file(file_path: str) -> Path:
-    global api_config
-    working_dir = Path(api_config.get("working_dir", "."))
-    target = (working_dir / file_path).resolve()
-    if working_dir.resolve().absolute() not in target.resolve().absolute().parents:
-        if not (target.exists() and target.samefile(working_dir)):
-            _log.warning("out of path: wdir=%s, target=%s", working_dir, target.resolve())
-            raise HTTPException(status_code=403, detail=f"cannot access to {file_path}")
+    target = (_working_dir_resolved / file_path).resolve()
+    try:
+        target.relative_to(_working_dir_resolved)
+    except ValueError:
+        _log.warning("out of path: wdir=%s, target=%s", _working_dir_resolved, target)
+        raise HTTPException(status_code=403, detail=f"cannot access to {file_path}")
     return target
 
 
 def file2uri(path: Path) -> str:
-    global api_config
-    working_dir = Path(api_config.get("working_dir", "."))
-    return str(path.relative_to(working_dir.resolve()))
+    return str(path.relative_to(_working_dir_resolved))
 
 
 def uriescape(uri: str, quote: bool = True) -> str:
@@ -49,6 +62,16 @@ def uriescape(uri: str, quote: bool = True) -> str:
     return html.escape(str(Path(api_config.get("prefix", "/")) / uri), quote)
 
 
+def uribase() -> str:
+    """prefix string of uri, uribase()+uri is same as str(Path(prefix) / uri)"""
+    base = str(Path(api_config.get("prefix", "/")))
+    if base == ".":
+        return ""
+    if base.endswith("/"):
+        return base
+    return base + "/"
+
+
 @router.get("/config")
 def read_config() -> dict:
     global api_config
@@ -56,59 +79,61 @@ def read_config() -> dict:
 
 
 @router.get("/read/{file_path:path}")
-def read_file(response: Response, file_path: str, accept_encoding: str = Header("")):
+def read_file(file_path: str, accept_encoding: str = Header("")):
     global api_config
     target = uri2file(file_path)
-    accepts = [x.strip() for x in accept_encoding.split(",")]
+    accepts = {x.strip() for x in accept_encoding.split(",")}
     media_type = api_config.get("content-type", "text/plain")
     # gzip or brotli passthrough case
-    special = {
-        "br": (".br",),
-        "gzip": (".gz",),
-    }
-    for acc, exts in special.items():
+    for acc, cext in passthrough_encodings:
         if acc in accepts:
-            for ext in exts:
-                if target.with_suffix(target.suffix + ext).is_file():
-                    response.headers["content-encoding"] = acc
-                    _log.info("compressed %s: %s", acc, target.with_suffix(target.suffix + ext))
-                    return StreamingResponse(
-                        content=target.with_suffix(target.suffix + ext).open("rb"),
-                        media_type=media_type,)
+            target_ext = Path(str(target) + cext)
+            if target_ext.is_file():
+                _log.info("compressed %s: %s", acc, target_ext)
+                return FileResponse(
+                    path=target_ext,
+                    media_type=media_type, headers={"content-encoding": acc})
     # uncompressed case
     if target.is_file():
         _log.info("raw %s: %s", acc, target)
-        return StreamingResponse(content=target.open("rb"), media_type=media_type)
+        return FileResponse(path=target, media_type=media_type)
     # other type case (directory, etc...)
     if target.exists():
         raise HTTPException(status_code=403, detail=f"cannot access to {file_path}")
     # compressed case
-    target_compressed = [x for x in target.parent.iterdir() if x.is_file() and x.name.startswith(target.name+".")]
+    target_compressed = [Path(x.path) for x in _scandir_prefix(target.parent, target.name+".")
+                         if x.is_file(follow_symlinks=False)]
     for p in target_compressed:
-        _, stream = auto_compress_stream(p, "decompress")
+        _, stream = auto_compress_stream(p, "decompress", FileReadStream(p.open("rb"), shutil.COPY_BUFSIZE))
         _log.info("auto decompress %s: %s", acc, p)
         return StreamingResponse(content=stream.gen(), media_type=media_type)
     raise HTTPException(status_code=404, detail=f"not found: {file_path}")
 
 
+def _parse_ymd(s: str) -> datetime.date:
+    """parse YYYY-mm-dd string, faster than datetime.strptime"""
+    if len(s) != 10 or s[4] != "-" or s[7] != "-":
+        raise ValueError(f"invalid date: {s}")
+    return datetime.date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+
+
 def reg_file(res: dict, p: Path):
-    if p.suffix in exts:
-        val = p.with_suffix("")
+    base, ext = os.path.splitext(str(p))
+    if ext in exts:
+        val = Path(base)
     else:
         val = p
     name = p.name
     try:
-        dt = datetime.datetime.strptime(name.split(".")[0], "%Y-%m-%d")
+        dt = _parse_ymd(name.split(".")[0])
     except ValueError:
         return
-    k2 = dt.strftime("%Y-%m-%d")
-    k1 = file2uri(p.parent)
-    v1 = file2uri(val)
+    k2 = dt.isoformat()
     try:
-        # check k1 and v1 are in working_dir tree
-        uri2file(k1)
-        uri2file(v1)
-    except HTTPException:
+        # p comes from a symlink-free walk under uri2file() target, check only prefix
+        k1 = file2uri(p.parent)
+        v1 = file2uri(val)
+    except ValueError:
         return
     if k1 not in res:
         res[k1] = {}
@@ -116,25 +141,59 @@ def reg_file(res: dict, p: Path):
         res[k1][k2] = v1
 
 
-def list_dir(file_path: str, file_prefix: str = "") -> dict[str, dict[str, str]]:
-    res = {}
+def _scandir_prefix(parent: Path, prefix: str) -> list[os.DirEntry]:
+    with os.scandir(parent) as it:
+        return [x for x in it if x.name.startswith(prefix)]
+
 
+def _scandir_recursive(p: str | os.PathLike):
+    with os.scandir(p) as it:
+        for e in it:
+            if e.is_symlink():
+                continue
+            if e.is_dir(follow_symlinks=False):
+                yield from _scandir_recursive(e.path)
+            elif e.is_file(follow_symlinks=False):
+                yield e
+
+
+def list_dir(file_path: str, file_prefix: str = "") -> dict[str, dict[str, str]]:
     target = uri2file(file_path)
+    try:
+        mtime = target.stat().st_mtime_ns
+    except FileNotFoundError:
+        mtime = target.parent.stat().st_mtime_ns
+    key = (file_path, file_prefix, mtime)
+    now = time.monotonic()
+    with _ldir_cache_lock:
+        ent = _ldir_cache.get(key)
+    if ent is not None and now - ent[0] < api_config.get("list_ttl", 5):
+        _log.debug("list_dir: cache hit %s", key)
+        return ent[1]
+    res = _list_dir(target, file_prefix)
+    with _ldir_cache_lock:
+        while len(_ldir_cache) >= _ldir_cache_size:
+            _ldir_cache.pop(next(iter(_ldir_cache)))
+        _ldir_cache[key] = (now, res)
+    return res
+
+
+def _list_dir(target: Path, file_prefix: str) -> dict[str, dict[str, str]]:
+    res = {}
     if target.is_dir():
-        targets = [target]
+        dirs = [str(target)]
     else:
-        targets = [x for x in target.parent.iterdir() if x.name.startswith(target.name)]
-
-    for target in targets:
-        if target.is_file():
-            reg_file(res, target)
-        elif target.is_dir():
-            for root, _, filenames in target.walk():
-                root = Path(root)
-                files = [root / x for x in filenames if Path(x).suffix in (exts | {".log", ".txt"})]
-                files = [x for x in files if x.name.startswith(file_prefix)]
-                for x in files:
-                    reg_file(res, x)
+        dirs = []
+        for entry in _scandir_prefix(target.parent, target.name):
+            if entry.is_file(follow_symlinks=False):
+                reg_file(res, Path(entry.path))
+            elif entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+
+    for d in dirs:
+        for x in _scandir_recursive(d):
+            if os.path.splitext(x.name)[1] in list_exts and x.name.startswith(file_prefix):
+                reg_file(res, Path(x.path))
     _log.debug("list_dir: keys=%s", res.keys())
     return res
 
@@ -152,85 +211,112 @@ def list_raw(file_path: str,
 
 @router.get("/html1/{file_path:path}")
 def html1(file_path: str, month=month_query):
-    def gen(ldir: dict[str, dict[str, str]]):
-        yield f"<html><title>{file_path}</title><body>"
+    async def gen(ldir: dict[str, dict[str, str]], chunk_size: int = 16384):
+        buf = io.StringIO()
+        buf.write(f"<html><title>{file_path}</title><body>")
+        base = uribase()
+        read_base = html.escape(f"{base}read/", True)
+        weekday_colors = api_config.get("weekday_colors", {})
         for title, files in ldir.items():
-            buf = io.StringIO()
-            uri = uriescape(f"html1/{title}")
+            uri = html.escape(f"{base}html1/{title}", True)
             buf.write('<div style="border: 1px solid black; float: left; margin: 10px; padding: 1em;">')
             buf.write(f'<h2><a href="{uri}">{title}</a></h2><ul>')
             premonth = None
             for dtstr in sorted(files.keys()):
-                dt = datetime.datetime.strptime(dtstr, "%Y-%m-%d")
-                month = dt.strftime("%Y-%m")
+                dt = _parse_ymd(dtstr)
+                month = dtstr[:7]
                 if premonth != month:
                     if premonth is not None:
                         buf.write("</li>")
                     buf.write(f"<li>{month}: ")
                     premonth = month
-                link = files[dtstr]
-                uri = uriescape(f"read/{link}")
-                linkhtml = f'<a href="{uri}">{dt.strftime("%d")}</a>'
-                color = api_config.get("weekday_colors", {}).get(dt.weekday())
+                link_uri = read_base + html.escape(files[dtstr], True)
+                linkhtml = f'<a href="{link_uri}">{dtstr[8:10]}</a>'
+                color = weekday_colors.get(dt.weekday())
                 if color is not None:
                     buf.write(f' <span style="background-color: {color};">{linkhtml}</span>')
                 else:
                     buf.write(f' {linkhtml}')
             buf.write("</li></ul>")
             buf.write('</div>')
-            yield buf.getvalue()
-        yield "</body></html>"
+            if buf.tell() >= chunk_size:
+                yield buf.getvalue().encode("utf-8")
+                buf.seek(0)
+                buf.truncate(0)
+        buf.write("</body></html>")
+        yield buf.getvalue().encode("utf-8")
     ldir = list_dir(file_path, month)
     if len(ldir) == 0:
         raise HTTPException(status_code=404, detail=f"not found: {file_path}")
     return StreamingResponse(content=gen(ldir), media_type="text/html")
 
 
-def html2_gen1(uri: str, month: str, files: dict[str, str]) -> str:
-    dt = datetime.datetime.strptime(month, "%Y-%m").date()
-    buf = io.StringIO()
-    buf.write(f'<tr><th colspan="7"><a href="{uri}?month={month}">{month}</a></th></tr>')
+@functools.lru_cache(maxsize=2048)
+def _month_skeleton(year: int, month: int, weekday_colors: tuple[tuple[int, str], ...],
+                    today_color: str | None, today: str) -> tuple[str, tuple[tuple[str, str, str], ...], str]:
+    """calendar layout of the month: (head, ((YYYY-mm-dd, day, td-open), ...), tail)"""
+    colors = dict(weekday_colors)
+    dt = datetime.date(year, month, 1)
     wday = (dt.weekday()+1) % 7
-    buf.write('<tr align="right">')
+    head = '<tr align="right">'
     if wday != 0:
-        buf.write(f'<td colspan="{wday}"></td>')
+        head += f'<td colspan="{wday}"></td>'
+    cells = []
+    tail = ""
     for i in range(32):
         cdt = dt + datetime.timedelta(days=i)
         wday = (cdt.weekday()+1) % 7
         if cdt.month != dt.month:
             if wday != 0:
-                buf.write(f'<td colspan="{7-wday}"></td>')
-            buf.write('</tr>')
+                tail += f'<td colspan="{7-wday}"></td>'
+            tail += '</tr>'
             break
+        td = ""
         if wday == 0:
-            buf.write('</tr><tr align="right">')
-        dtstr = cdt.strftime("%Y-%m-%d")
-        if cdt == datetime.date.today():
-            color = api_config.get("today_color")
+            td += '</tr><tr align="right">'
+        dtstr = cdt.isoformat()
+        if dtstr == today:
+            color = today_color
         else:
-            color = api_config.get("weekday_colors", {}).get(cdt.weekday())
+            color = colors.get(cdt.weekday())
         if color is None:
-            buf.write('<td>')
+            td += '<td>'
         else:
-            buf.write(f'<td style="background-color: {color};">')
-        if dtstr in files:
-            link = files[dtstr]
-            uri = uriescape(f"read/{link}")
-            buf.write(f'<a href="{uri}">{cdt.day}</a>')
+            td += f'<td style="background-color: {color};">'
+        cells.append((dtstr, str(cdt.day), td))
+    tail += '</tr>'
+    return head, tuple(cells), tail
+
+
+def html2_gen1(uri: str, month: str, files: dict[str, str], base: str | None = None) -> str:
+    if base is None:
+        base = uribase()
+    read_base = html.escape(f"{base}read/", True)
+    head, cells, tail = _month_skeleton(
+        int(month[:4]), int(month[5:]),
+        tuple(api_config.get("weekday_colors", {}).items()), api_config.get("today_color"),
+        datetime.date.today().isoformat())
+    res = [f'<tr><th colspan="7"><a href="{uri}?month={month}">{month}</a></th></tr>', head]
+    for dtstr, day, td in cells:
+        link = files.get(dtstr)
+        if link is None:
+            res.append(f'{td}{day}</td>')
         else:
-            buf.write(f"{cdt.day}")
-        buf.write('</td>')
-    buf.write('</tr>')
-    return buf.getvalue()
+            cell_uri = read_base + html.escape(link, True)
+            res.append(f'{td}<a href="{cell_uri}">{day}</a></td>')
+    res.append(tail)
+    return "".join(res)
 
 
-def html2_gen(ldir: dict[str, dict[str, str]], file_path: str):
+async def html2_gen(ldir: dict[str, dict[str, str]], file_path: str, chunk_size: int = 65536):
     buf = io.StringIO()
     buf.write(f"<html><title>{file_path}</title><body>")
     thismonth = datetime.date.today().strftime("%Y-%m")
     buf.write(f'<p><a href="?month={thismonth}">this month</a></p>')
+    base = uribase()
+    weekday_colors = api_config.get("weekday_colors", {})
     for title, files in ldir.items():
-        uri = uriescape(f"html2/{title}")
+        uri = html.escape(f"{base}html2/{title}", True)
         buf.write('<div style="float: left; margin: 1em;">')
         buf.write(f'<h2><a href="{uri}">{title}</a></h2>')
         buf.write('<table border="1" style="border-collapse: collapse"><tr>')
@@ -238,20 +324,24 @@ def html2_gen(ldir: dict[str, dict[str, str]], file_path: str):
         for i in range(7):
             wd = (b+datetime.timedelta(days=i))
             wdstr = wd.strftime("%a")
-            color = api_config.get("weekday_colors", {}).get(wd.weekday())
+            color = weekday_colors.get(wd.weekday())
             if color:
                 buf.write(f'<th style="background-color: {color};"><code>{wdstr}</code></th>')
             else:
                 buf.write(f'<th><code>{wdstr}</code></th>')
         buf.write('</tr>')
-        months = {x.rsplit("-", 1)[0] for x in files.keys()}
+        months: dict[str, dict[str, str]] = {}
+        for k, v in files.items():
+            months.setdefault(k[:7], {})[k] = v
         for month in sorted(months):
-            buf.write(html2_gen1(uri, month, files))
+            buf.write(html2_gen1(uri, month, months[month], base))
         buf.write("</table></div>")
-        yield buf.getvalue()
-        buf.truncate(0)
-        buf.seek(0)
-    yield "</body></html>"
+        if buf.tell() >= chunk_size:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate(0)
+    buf.write("</body></html>")
+    yield buf.getvalue().encode("utf-8")
 
 
 @router.get("/html2/{file_path:path}")
@@ -262,22 +352,36 @@ def html2(file_path: str, month=month_query):
     return StreamingResponse(content=html2_gen(ldir, file_path), media_type="text/html")
 
 
-def find_target(p: Path, accepts: list[str]) -> Path:
+def _file_names(parent: Path) -> set[str]:
+    with os.scandir(parent) as it:
+        return {x.name for x in it if x.is_file(follow_symlinks=False)}
+
+
+def find_target(p: Path, accepts: list[str], present: set[str] | None = None) -> Path:
+    """
+    choose the file to read for p
+
+    args:
+        p: target path (may not exist)
+        accepts: accept-encoding list
+        present: file names in p.parent. if None, scan directory.
+    """
+    if present is None:
+        present = _file_names(p.parent)
+    name = p.name
     # gzip pass through
-    if "gzip" in accepts:
-        if p.with_suffix(p.suffix + ".gz").is_file():
-            return p.with_suffix(p.suffix + ".gz")
+    if "gzip" in accepts and name + ".gz" in present:
+        return p.parent / (name + ".gz")
     # raw pass through
-    if p.is_file():
+    if name in present:
         return p
     # others
-    if "br" in accepts:
-        if p.with_suffix(p.suffix + ".br").exists():
-            return p.with_suffix(p.suffix + ".br")
+    if "br" in accepts and name + ".br" in present:
+        return p.parent / (name + ".br")
     # compressed case
-    target_compressed = [x for x in p.parent.iterdir() if x.is_file() and x.name.startswith(p.name+".")]
+    target_compressed = sorted(x for x in present if x.startswith(name + "."))
     if len(target_compressed):
-        return target_compressed[0]
+        return p.parent / target_compressed[0]
     raise HTTPException(status_code=404, detail=f"not found: {p}")
 
 
@@ -289,10 +393,13 @@ def get_streams(files: dict[str, dict[str, str]], accepts: list[str]) -> tuple[l
                 outputs[k] = []
             outputs[k].append(fn)
     output_list: list[Path] = []
+    dir_files: dict[Path, set[str]] = {}
     for k in sorted(outputs.keys()):
         for fname in sorted(outputs[k]):
             target = uri2file(fname)
-            target_file = find_target(target, accepts)
+            if target.parent not in dir_files:
+                dir_files[target.parent] = _file_names(target.parent)
+            target_file = find_target(target, accepts, dir_files[target.parent])
             output_list.append(target_file)
     mode = "decompress"
     hdrs = {}
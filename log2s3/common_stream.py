@@ -1,16 +1,26 @@
-import io
+import heapq
+import queue
+import threading
 from typing import Generator, Sequence
 from logging import getLogger
 
 _log = getLogger(__name__)
 
 
+def _universal_newlines(data: bytes) -> bytes:
+    """translate CRLF and CR to LF, as io.TextIOWrapper"""
+    if b"\r" in data:
+        return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    return data
+
+
 class Stream:
     """
     stream base class
 
     work as pass-through stream
     """
+    compact_size = 1024*1024
 
     def __init__(self, prev_stream):
         self.prev = prev_stream
@@ -19,7 +29,8 @@ class Stream:
         """prepare self as file-like interface"""
         _log.debug("use as fp(%s)", self.__class__.__name__)
         self.gen1 = self.prev.gen()
-        self.buf = [next(self.gen1)]
+        self.buf = bytearray(next(self.gen1, b""))
+        self.pos = 0
         self.eof = False
 
     # work as pass-thru stream
@@ -29,28 +40,24 @@ class Stream:
 
     def read_all(self) -> bytes:
         """read all content"""
-        buf = io.BytesIO()
-        for i in self.gen():
-            _log.debug("read %d bytes", len(i))
-            buf.write(i)
-        _log.debug("finish read")
-        return buf.getvalue()
+        parts = list(self.gen())
+        _log.debug("finish read: %d parts", len(parts))
+        return b"".join(parts)
 
     def text_gen(self) -> Generator[str, None, None]:
         """readline generator"""
+        # complete lines never split a UTF-8 sequence: decode each line by itself
         rest = b""
         for i in self.gen():
-            d = i.rfind(b'\n')
-            if d != -1:
-                buf0 = io.BytesIO(rest + i[:d+1])
-                rest = i[d+1:]
-                buf = io.TextIOWrapper(buf0)
-                yield from buf
-            else:
-                rest = rest + i
+            d = i.rfind(b"\n")
+            if d == -1:
+                rest += i
+                continue
+            lines = rest + i[:d+1] if rest else i[:d+1]
+            rest = i[d+1:]
+            yield from map(bytes.decode, _universal_newlines(lines).splitlines(keepends=True))
         if rest:
-            buf = io.TextIOWrapper(io.BytesIO(rest))
-            yield from buf
+            yield from map(bytes.decode, _universal_newlines(rest).splitlines(keepends=True))
 
     def read(self, sz: int = -1) -> bytes:
         """
@@ -64,35 +71,73 @@ class Stream:
         assert hasattr(self, "eof")
         if self.eof:
             return b""
-        if sz == -1:
-            _log.debug("read all")
-            try:
-                while True:
-                    self.buf.append(next(self.gen1))
-            except StopIteration:
-                _log.debug("read %s / %s", len(self.buf), sum([len(x) for x in self.buf]))
-            buf = self.buf
-            self.buf = []
-            self.eof = True
-            return b"".join(buf)
-        cur = sum([len(x) for x in self.buf])
         try:
-            _log.debug("read part cur=%s / sz=%s", cur, sz)
-            while cur < sz:
-                bt = next(self.gen1)
-                _log.debug("read1 %d / cur=%s, sz=%s", len(bt), cur, sz)
-                self.buf.append(bt)
-                cur += len(bt)
-            buf = b"".join(self.buf)
-            self.buf = [buf[sz:]]
-            _log.debug("return %s, rest=%s", sz, len(self.buf[0]))
-            return buf[:sz]
+            if sz == -1:
+                _log.debug("read all")
+                while True:
+                    self.buf.extend(next(self.gen1))
+            while len(self.buf) - self.pos < sz:
+                self.buf.extend(next(self.gen1))
         except StopIteration:
-            _log.debug("eof %s / %s", len(self.buf), sum([len(x) for x in self.buf]))
-            buf = self.buf
-            self.buf = []
+            _log.debug("eof %s", len(self.buf) - self.pos)
+            res = bytes(memoryview(self.buf)[self.pos:])
+            self.buf = bytearray()
+            self.pos = 0
             self.eof = True
-            return b"".join(buf)
+            return res
+        res = bytes(memoryview(self.buf)[self.pos:self.pos+sz])
+        self.pos += sz
+        if self.pos > self.compact_size:
+            del self.buf[:self.pos]
+            self.pos = 0
+        return res
+
+
+class PrefetchStream(Stream):
+    """
+    read prev_stream in background thread, overlap I/O and (de)compression
+
+    args:
+        prefetch: number of chunks to read ahead
+    """
+
+    def __init__(self, prev_stream, prefetch: int = 2):
+        super().__init__(prev_stream)
+        self.prefetch = prefetch
+
+    @staticmethod
+    def _put(q: queue.Queue, stop: threading.Event, item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _pump(self, q: queue.Queue, stop: threading.Event):
+        try:
+            for i in self.prev.gen():
+                if not self._put(q, stop, i):
+                    return
+        except Exception as e:
+            self._put(q, stop, e)
+            return
+        self._put(q, stop, None)
+
+    def gen(self) -> Generator[bytes, None, None]:
+        q: queue.Queue = queue.Queue(self.prefetch)
+        stop = threading.Event()
+        th = threading.Thread(target=self._pump, args=(q, stop), daemon=True)
+        th.start()
+        try:
+            while (i := q.get()) is not None:
+                if isinstance(i, Exception):
+                    raise i
+                yield i
+        finally:
+            stop.set()
+            th.join()
 
 
 class CatStream:
@@ -105,31 +150,24 @@ class CatStream:
 
 
 class MergeStream:
-    def __init__(self, inputs: Sequence[Stream], bufsize: int = 4096):
+    def __init__(self, inputs: Sequence[Stream], bufsize: int = 256*1024):
         self.inputs = inputs
         self.bufsize = bufsize
 
     def gen(self) -> Generator[bytes, None, None]:
-        buf = io.BytesIO()
+        # coalesce lines into large chunks, avoid many small writes to http response
+        parts: list[str] = []
+        append, bufsize = parts.append, self.bufsize
+        size = 0
         for i in self.text_gen():
-            buf.write(i.encode("utf-8"))
-            if buf.tell() > self.bufsize:
-                yield buf.getvalue()
-                buf.truncate(0)
-                buf.seek(0)
-        yield buf.getvalue()
+            append(i)
+            size += len(i)
+            if size > bufsize:
+                yield "".join(parts).encode("utf-8")
+                parts.clear()
+                size = 0
+        if parts:
+            yield "".join(parts).encode("utf-8")
 
     def text_gen(self) -> Generator[str, None, None]:
-        txt_gens = [x.text_gen() for x in self.inputs]
-        input_files = [[next(x), x] for x in txt_gens]
-        input_files.sort(key=lambda f: f[0])
-        while len(input_files) != 0:
-            yield input_files[0][0]
-            try:
-                input_files[0][0] = next(input_files[0][1])
-                if len(input_files) == 1 or input_files[0][0] < input_files[1][0]:
-                    # already sorted
-                    continue
-            except StopIteration:
-                input_files.pop(0)
-            input_files.sort(key=lambda f: f[0])
+        yield from heapq.merge(*[x.text_gen() for x in self.inputs])
@@ -1,12 +1,20 @@
 import lzma
 import bz2
-import gzip
+import zlib
 import pathlib
-from .common_stream import Stream
-from typing import Optional, Callable
+import types
+import functools
+import itertools
+import collections
+import concurrent.futures
+import mmap
+import threading
+from .common_stream import Stream, PrefetchStream
+from typing import Optional, Callable, Any, Mapping
 from logging import getLogger
 import io
 import os
+import stat
 try:
     from mypy_boto3_s3.client import S3Client as S3ClientType
 except ImportError:
@@ -15,6 +23,46 @@ except ImportError:
 _log = getLogger(__name__)
 
 
+def _gzip_backend(name: str):
+    """
+    zlib compatible module for gzip
+
+    args:
+        name: "isal", "zlib-ng" or "stdlib". empty: prefer accelerated implementation
+    """
+    if name not in ("", "isal", "zlib-ng", "stdlib"):
+        _log.warning("unknown gzip backend: %s", name)
+        name = ""
+    if name in ("", "isal"):
+        try:
+            from isal import isal_zlib   # type: ignore
+            return isal_zlib
+        except ImportError:
+            if name:
+                _log.warning("isal is not installed, use default gzip backend")
+    if name in ("", "zlib-ng", "isal"):
+        try:
+            from zlib_ng import zlib_ng   # type: ignore
+            return zlib_ng
+        except ImportError:
+            if name == "zlib-ng":
+                _log.warning("zlib-ng is not installed, use stdlib zlib")
+    return zlib
+
+
+_zlib = _gzip_backend(os.getenv("LOG2S3_GZIP_BACKEND", ""))
+
+# one-shot gzip compression of in-memory data (libdeflate), when no accelerated zlib is available
+_gzip_oneshot: Optional[Callable[[Any], Any]] = None
+gzip_oneshot_limit = 64*1024*1024
+if _zlib is zlib:
+    try:
+        import deflate
+        _gzip_oneshot = functools.partial(deflate.gzip_compress, compresslevel=9)
+    except ImportError:
+        pass
+
+
 class FileReadStream(Stream):
     """
     Read from file, stream interface
@@ -25,12 +73,28 @@ class FileReadStream(Stream):
         self.bufsize = bufsize
 
     def gen(self):
-        while True:
-            data = self.fd.read(self.bufsize)
-            if data is None or len(data) == 0:
-                break
-            _log.debug("read file %d", len(data))
-            yield data
+        # stop at EOF(b"") or no data from non-blocking file(None)
+        yield from itertools.takewhile(bool, iter(functools.partial(self.fd.read, self.bufsize), b""))
+
+
+class MmapReadStream(Stream):
+    """
+    Read from memory-mapped file, yield memoryview without copy
+
+    chunks are memoryview, use only as input of compressor/decompressor
+    """
+
+    def __init__(self, file_like: io.RawIOBase | io.BufferedReader, bufsize=10*1024*1024):
+        self.mm = mmap.mmap(file_like.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self.mm, "madvise"):
+            self.mm.madvise(mmap.MADV_SEQUENTIAL)
+        self.bufsize = bufsize
+
+    def gen(self):
+        # keep mmap open: consumer may hold views after the end of generator
+        view = memoryview(self.mm)
+        for off in range(0, len(view), self.bufsize):
+            yield view[off:off+self.bufsize]
 
 
 class RawReadStream(Stream):
@@ -39,16 +103,22 @@ class RawReadStream(Stream):
     """
 
     def __init__(self, data: bytes, bufsize=1024*1024):
-        self.fd = io.BytesIO(data)
+        self.data = data
         self.bufsize = bufsize
 
+    def read_all(self) -> bytes:
+        return self.data
+
     def gen(self):
-        while True:
-            data = self.fd.read(self.bufsize)
-            _log.debug("read file %d", len(data))
-            if len(data) == 0:
-                break
-            yield data
+        data, bufsize = self.data, self.bufsize
+        if len(data) <= bufsize:
+            # whole data in one chunk, without copy
+            if data:
+                yield data
+            return
+        # yield bytes, not memoryview: some consumers (text_gen, brotli) need bytes
+        for off in range(0, len(data), bufsize):
+            yield data[off:off+bufsize]
 
 
 class FileWriteStream(Stream):
@@ -61,9 +131,33 @@ class FileWriteStream(Stream):
         self.fd = file_like
         self.bufsize = bufsize
 
+    def _sendfile_fds(self) -> Optional[tuple[int, int]]:
+        # raw passthrough from a regular file to a regular file: let the kernel copy
+        if type(self.prev) is not FileReadStream or not hasattr(os, "sendfile"):
+            return None
+        try:
+            in_fd, out_fd = self.prev.fd.fileno(), self.fd.fileno()
+        except (OSError, AttributeError, io.UnsupportedOperation):
+            return None
+        if not (stat.S_ISREG(os.fstat(in_fd).st_mode) and stat.S_ISREG(os.fstat(out_fd).st_mode)):
+            return None
+        return in_fd, out_fd
+
     def gen(self):
-        for i in self.prev.gen():
-            yield self.fd.write(i)
+        fds = self._sendfile_fds()
+        if fds is None:
+            yield from map(self.fd.write, self.prev.gen())
+            return
+        in_fd, out_fd = fds
+        self.fd.flush()
+        in_pos, out_pos = self.prev.fd.tell(), self.fd.tell()
+        os.lseek(out_fd, out_pos, os.SEEK_SET)
+        while (sent := os.sendfile(out_fd, in_fd, in_pos, self.prev.bufsize)) > 0:
+            in_pos += sent
+            out_pos += sent
+            yield sent
+        self.prev.fd.seek(in_pos)
+        self.fd.seek(out_pos)
 
 
 class S3GetStream(Stream):
@@ -71,37 +165,161 @@ class S3GetStream(Stream):
     Read data from S3 object with chunked read.
     """
 
-    def __init__(self, s3_client: S3ClientType, bucket: str, key: str, bufsize=1024*1024):
-        self.obj = s3_client.get_object(Bucket=bucket, Key=key)
+    def __init__(self, s3_client: S3ClientType, bucket: str, key: str, bufsize=1024*1024, **args):
+        self.obj = s3_client.get_object(Bucket=bucket, Key=key, **args)
         self.bufsize = bufsize
 
     def gen(self):
         yield from self.obj["Body"].iter_chunks(self.bufsize)
 
 
+class S3RangedGetStream(Stream):
+    """
+    Read data from S3 object with parallel ranged GET, yield parts in order.
+
+    at most `concurrency` parts are in flight or buffered.
+
+    args:
+        first: response of the first part (already requested), rest is read from part_size
+    """
+
+    def __init__(self, s3_client: S3ClientType, bucket: str, key: str, size: int, etag: Optional[str] = None,
+                 part_size: Optional[int] = None, concurrency: Optional[int] = None,
+                 first: Optional[Stream] = None):
+        self.client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.part_size = part_size or s3_ranged_part_size
+        self.concurrency = concurrency or s3_ranged_concurrency
+        self.first = first
+
+    def _get(self, start: int, end: int) -> bytes:
+        args = {"Bucket": self.bucket, "Key": self.key, "Range": f"bytes={start}-{end}"}
+        if self.etag:
+            # fail if object is replaced while reading
+            args["IfMatch"] = self.etag
+        return self.client.get_object(**args)["Body"].read()   # type: ignore
+
+    def gen(self):
+        start = 0 if self.first is None else self.part_size
+        ranges = ((x, min(x + self.part_size, self.size) - 1) for x in range(start, self.size, self.part_size))
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+            futures = collections.deque(executor.submit(self._get, *x)
+                                        for x in itertools.islice(ranges, self.concurrency))
+            try:
+                if self.first is not None:
+                    # next parts are fetched while reading the first one
+                    yield from self.first.gen()
+                while futures:
+                    data = futures.popleft().result()
+                    for x in itertools.islice(ranges, 1):
+                        futures.append(executor.submit(self._get, *x))
+                    yield data
+            finally:
+                for f in futures:
+                    f.cancel()
+
+
+s3_ranged_threshold = 32*1024*1024
+# parts of S3RangedGetStream in flight
+s3_ranged_concurrency = 8
+s3_ranged_part_size = 8*1024*1024
+
+
+def s3_get_stream(s3_client: S3ClientType, bucket: str, key: str, size: Optional[int] = None,
+                  etag: Optional[str] = None) -> Stream:
+    """
+    S3 read stream, parallel ranged GET for large object
+
+    if size is unknown, the first GET requests the first part only. size is taken from its ContentRange
+    """
+    if size is not None:
+        if size > s3_ranged_threshold:
+            return S3RangedGetStream(s3_client, bucket, key, size, etag)
+        return S3GetStream(s3_client, bucket, key)
+    from botocore.exceptions import ClientError
+    try:
+        res = S3GetStream(s3_client, bucket, key, Range=f"bytes=0-{s3_ranged_part_size - 1}")
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "InvalidRange":
+            raise
+        # empty object: no range can be satisfied
+        return S3GetStream(s3_client, bucket, key)
+    # no ContentRange: whole object is returned
+    content_range = res.obj.get("ContentRange")
+    total = int(content_range.rpartition("/")[2]) if content_range else 0
+    if total <= s3_ranged_part_size:
+        return res
+    return S3RangedGetStream(s3_client, bucket, key, total, res.obj.get("ETag"), first=res)
+
+
+# TransferConfig of S3PutStream: upload parts of large objects concurrently
+s3_transfer_options = {
+    "multipart_threshold": 8*1024*1024,
+    "multipart_chunksize": 16*1024*1024,
+    "max_concurrency": (os.cpu_count() or 1) * 2,
+    "use_threads": True,
+}
+
+
+def s3_transfer_config(max_concurrency: Optional[int] = None):
+    """TransferConfig from s3_transfer_options, with max_concurrency if given"""
+    from boto3.s3.transfer import TransferConfig
+    opts = dict(s3_transfer_options)
+    if max_concurrency is not None:
+        opts["max_concurrency"] = max_concurrency
+    return TransferConfig(**opts)
+
+
 class S3PutStream(Stream):
     """
     Read data from prev_stream and write to S3 object.
     """
 
-    def __init__(self, prev_stream, s3_client: S3ClientType, bucket: str, key: str, bufsize=1024*1024):
+    def __init__(self, prev_stream, s3_client: S3ClientType, bucket: str, key: str, bufsize=1024*1024,
+                 transfer_config=None, prefetch: int = 4):
         super().__init__(prev_stream)
         self.client = s3_client
         self.bucket = bucket
         self.key = key
         self.bufsize = bufsize
-        self.init_fp()
-        _log.debug("eof is %s", self.eof)
+        if transfer_config is None:
+            transfer_config = s3_transfer_config()
+        self.transfer_config = transfer_config
+        self.lock = threading.Lock()
+        if type(prev_stream) is FileReadStream:
+            # raw passthrough: upload from the file itself
+            self.fp = prev_stream.fd
+        else:
+            # (de)compress in background thread while uploading previous parts
+            self.prev = PrefetchStream(prev_stream, prefetch)
+            self.init_fp()
+            self.fp = self
+            _log.debug("eof is %s", self.eof)
+
+    def read(self, sz: int = -1) -> bytes:
+        # transfer threads may read concurrently
+        with self.lock:
+            return super().read(sz)
 
     def gen(self):
         _log.debug("gen: bucket=%s, key=%s", self.bucket, self.key)
-        self.client.upload_fileobj(self, self.bucket, self.key)   # type: ignore
+        try:
+            self.client.upload_fileobj(self.fp, self.bucket, self.key, Config=self.transfer_config)   # type: ignore
+        finally:
+            if self.fp is self:
+                # stop background thread, even if upload failed halfway
+                self.gen1.close()
         yield b""
 
 
 class SimpleFilterStream(Stream):
     """
     simple compress/decompress function as stream interface, base class
+
+    reads whole input into memory. only for codecs without incremental API (lzfse, lzo, zpaq, zopfli)
     """
 
     def __init__(self, prev_stream, filter_fn: Callable[[bytes], bytes]):
@@ -116,17 +334,58 @@ class ComprFlushStream(Stream):
     """
     repeat compress, and finally flush()
     """
+    # input block size of codec. reads of input stream are aligned to multiple of this
+    block_size: Optional[int] = None
 
     def __init__(self, prev_stream, compressor):
         super().__init__(prev_stream)
         self.compr = compressor
+        if self.block_size:
+            self.align_input(self.block_size)
+
+    def align_input(self, size: int):
+        """round read size of input file/mmap/S3 stream (also behind PrefetchStream) to multiple of size"""
+        src = self.prev
+        if isinstance(src, PrefetchStream):
+            src = src.prev
+        if isinstance(src, (FileReadStream, MmapReadStream, S3GetStream)):
+            src.bufsize = max(size, src.bufsize // size * size)
 
     def gen(self):
-        for i in self.prev.gen():
-            _log.debug("compress %d", len(i))
-            yield self.compr.compress(i)
-        _log.debug("flush")
-        yield self.compr.flush()
+        # skip empty outputs while compressor buffers input
+        yield from filter(None, map(self.compr.compress, self.prev.gen()))
+        if tail := self.compr.flush():
+            yield tail
+
+
+class CompressorPool:
+    """
+    per-thread free list of compressor contexts, reused across streams
+
+    construction of some contexts (zstd with large window, lz4) costs more than compressing a small file
+    """
+
+    def __init__(self, factory: Callable[..., Any], maxsize: int = 4):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.local = threading.local()
+
+    def _free(self, key: tuple) -> list:
+        return self.local.__dict__.setdefault("free", {}).setdefault(key, [])
+
+    def acquire(self, *args):
+        free = self._free(args)
+        if free:
+            return free.pop()
+        return self.factory(*args)
+
+    def release(self, obj, *args):
+        free = self._free(args)
+        if len(free) < self.maxsize:
+            free.append(obj)
+
+    def clear(self):
+        self.local = threading.local()
 
 
 class DecompStream(Stream):
@@ -139,17 +398,109 @@ class DecompStream(Stream):
         self.decompr = decompressor
 
     def gen(self):
-        for i in self.prev.gen():
-            yield self.decompr.decompress(i)
+        yield from filter(None, map(self.decompr.decompress, self.prev.gen()))
+
+
+class MultiFrameDecompressor:
+    """
+    incremental decompressor for concatenated frames (members)
+
+    restart decompressor made by factory() when a frame ends.
+    decompressor should have decompress(), eof and unused_data.
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self.factory = factory
+        self.decompr = factory()
+
+    def decompress(self, data: bytes) -> bytes:
+        res = [self.decompr.decompress(data)]
+        while self.decompr.eof:
+            data = self.decompr.unused_data
+            self.decompr = self.factory()
+            if not data:
+                break
+            res.append(self.decompr.decompress(data))
+        return b"".join(res)
+
+
+# number of compress threads (gzip, bzip2, xz, zstd). None: all logical cpus
+compress_threads: Optional[int] = None
+# input size of xz block compressed by each thread. same as xz -T (3 x dict size of preset 6)
+xz_block_size = 24*1024*1024
+# max xz threads unless compress_threads is set: each thread uses ~100MB (encoder + blocks)
+xz_max_threads = 4
+# input size of gzip member / bzip2 stream compressed by each thread
+parallel_block_size = 8*1024*1024
+
+
+def _rechunk(chunks, size: int):
+    buf = bytearray()
+    for i in chunks:
+        if not buf:
+            # aligned input (align_input): whole blocks without copy
+            view = memoryview(i)
+            n = len(view) // size * size
+            yield from (view[x:x+size] for x in range(0, n, size))
+            i = view[n:]
+        buf += i
+        while len(buf) >= size:
+            yield bytes(memoryview(buf)[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+
+def parallel_compress(chunks, compress_fn: Callable[[bytes], bytes], threads: int, block_size: int):
+    """
+    compress fixed size blocks in thread pool, yield in order.
+    output is concatenation of independent streams (xz, bz2, gzip, zstd can decompress it).
+    """
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        pending: collections.deque = collections.deque()
+        for block in _rechunk(chunks, block_size):
+            pending.append(executor.submit(compress_fn, block))
+            if len(pending) > threads:
+                yield pending.popleft().result()
+        if not pending:
+            yield compress_fn(b"")
+        while pending:
+            yield pending.popleft().result()
+
+
+def _input_length(st: Stream) -> Optional[int]:
+    """length of in-memory or memory-mapped input, None if unknown"""
+    if isinstance(st, RawReadStream):
+        return len(st.data)
+    if isinstance(st, MmapReadStream):
+        return len(st.mm)
+    return None
 
 
 class XzCompressorStream(ComprFlushStream):
     """
     compressor stream for .xz format
+
+    with multiple threads, input is split into blocks and compressed in parallel (as xz -T)
     """
+    block_size = 1024*1024
 
-    def __init__(self, prev_stream):
-        super().__init__(prev_stream, lzma.LZMACompressor(format=lzma.FORMAT_XZ))
+    def __init__(self, prev_stream, threads: Optional[int] = None):
+        super().__init__(prev_stream, None)
+        if threads is None and compress_threads:
+            self.threads = compress_threads
+        else:
+            self.threads = min(threads or os.cpu_count() or 1, xz_max_threads)
+
+    def gen(self):
+        if self.threads <= 1:
+            # encoder state is large: only for single thread
+            self.compr = lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+            yield from super().gen()
+            return
+        self.align_input(xz_block_size)
+        yield from parallel_compress(self.prev.gen(), functools.partial(lzma.compress, format=lzma.FORMAT_XZ),
+                                     self.threads, xz_block_size)
 
 
 class LzmaCompressorStream(ComprFlushStream):
@@ -167,7 +518,8 @@ class XzDecompressorStream(DecompStream):
     """
 
     def __init__(self, prev_stream):
-        super().__init__(prev_stream, lzma.LZMADecompressor(format=lzma.FORMAT_AUTO))
+        super().__init__(prev_stream, MultiFrameDecompressor(functools.partial(
+            lzma.LZMADecompressor, format=lzma.FORMAT_AUTO)))
 
 
 LzmaDecompressorStream = XzDecompressorStream
@@ -176,10 +528,22 @@ LzmaDecompressorStream = XzDecompressorStream
 class Bz2CompressorStream(ComprFlushStream):
     """
     compressor stream for .bz2 format
+
+    with multiple threads, output is multi-stream file (as pbzip2)
     """
+    block_size = 900*1000
 
-    def __init__(self, prev_stream):
-        super().__init__(prev_stream, bz2.BZ2Compressor())
+    def __init__(self, prev_stream, threads: Optional[int] = None):
+        super().__init__(prev_stream, None)
+        self.threads = threads or compress_threads or os.cpu_count() or 1
+
+    def gen(self):
+        if self.threads <= 1:
+            self.compr = bz2.BZ2Compressor()
+            yield from super().gen()
+            return
+        self.align_input(parallel_block_size)
+        yield from parallel_compress(self.prev.gen(), bz2.compress, self.threads, parallel_block_size)
 
 
 class Bz2DecompressorStream(DecompStream):
@@ -188,25 +552,59 @@ class Bz2DecompressorStream(DecompStream):
     """
 
     def __init__(self, prev_stream):
-        super().__init__(prev_stream, bz2.BZ2Decompressor())
+        super().__init__(prev_stream, MultiFrameDecompressor(bz2.BZ2Decompressor))
 
 
-class GzipCompressorStream(SimpleFilterStream):
+class GzipCompressorStream(ComprFlushStream):
     """
     compressor stream for .gz format
+
+    with multiple threads, output is multi-member file (as pigz --independent)
     """
 
-    def __init__(self, prev_stream):
-        super().__init__(prev_stream, gzip.compress)
+    def __init__(self, prev_stream, zlib_module=_zlib, threads: Optional[int] = None):
+        super().__init__(prev_stream, None)
+        self.zlib_module = zlib_module
+        self.threads = threads or compress_threads or os.cpu_count() or 1
+
+    def gen(self):
+        if _gzip_oneshot is not None and self.zlib_module is _zlib:
+            if isinstance(self.prev, RawReadStream):
+                data = self.prev.data
+            elif isinstance(self.prev, MmapReadStream):
+                data = self.prev.mm
+            else:
+                data = None
+            if data is not None and len(data) <= gzip_oneshot_limit:
+                yield bytes(_gzip_oneshot(data))
+                return
+        if self.threads > 1:
+            zm = self.zlib_module
+            compress_fn = functools.partial(zm.compress, level=zm.Z_BEST_COMPRESSION, wbits=16 + zm.MAX_WBITS)
+            self.align_input(parallel_block_size)
+            yield from parallel_compress(self.prev.gen(), compress_fn, self.threads, parallel_block_size)
+            return
+        zm = self.zlib_module
+        self.compr = zm.compressobj(zm.Z_BEST_COMPRESSION, zm.DEFLATED, 16 + zm.MAX_WBITS)
+        yield from super().gen()
+
+
+class GzipDecompressor(MultiFrameDecompressor):
+    """
+    incremental decompressor for .gz format, supports multi-member file
+    """
+
+    def __init__(self, zlib_module=_zlib):
+        super().__init__(lambda: zlib_module.decompressobj(16 + zlib_module.MAX_WBITS))
 
 
-class GzipDecompressorStream(SimpleFilterStream):
+class GzipDecompressorStream(DecompStream):
     """
     decompressor stream for .gz format
     """
 
-    def __init__(self, prev_stream):
-        super().__init__(prev_stream, gzip.decompress)
+    def __init__(self, prev_stream, zlib_module=_zlib):
+        super().__init__(prev_stream, GzipDecompressor(zlib_module))
 
 
 stream_map: dict[str, tuple[str, type[Stream], type[Stream]]] = {
@@ -219,33 +617,89 @@ stream_map: dict[str, tuple[str, type[Stream], type[Stream]]] = {
 
 
 try:
-    import zstd
+    import zstandard
 
-    class ZstdCompressorStream(SimpleFilterStream):
-        def __init__(self, prev_stream):
-            super().__init__(prev_stream, zstd.compress)
+    # trained dictionary shared by all zstd streams (see set_zstd_dict)
+    zstd_dict: Optional[zstandard.ZstdCompressionDict] = None
+
+    def set_zstd_dict(data: Optional[bytes]):
+        global zstd_dict
+        zstd_dict = zstandard.ZstdCompressionDict(data) if data else None
+        _zstd_pool.clear()
+
+    def train_zstd_dict(samples: list[bytes], size: int) -> bytes:
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+    def _zstd_compressor(level: int, threads: int, long_distance: bool) -> zstandard.ZstdCompressor:
+        # threads=-1: use all logical cpus
+        # long_distance: 128MB window with long distance matching, for repetitive logs
+        ldm = {"window_log": 27, "enable_ldm": True} if long_distance else {}
+        params = zstandard.ZstdCompressionParameters.from_level(level, threads=threads, **ldm)
+        return zstandard.ZstdCompressor(compression_params=params, dict_data=zstd_dict)
+
+    _zstd_pool = CompressorPool(_zstd_compressor)
+
+    class ZstdCompressorStream(ComprFlushStream):
+        block_size = zstandard.COMPRESSION_RECOMMENDED_INPUT_SIZE
+
+        def __init__(self, prev_stream, level: int = 3, threads: Optional[int] = None, long_distance: bool = True):
+            super().__init__(prev_stream, None)
+            if threads is None:
+                threads = compress_threads or -1
+            self.params = (level, threads, long_distance)
 
-    class ZstdDecompressorStream(SimpleFilterStream):
+        def gen(self):
+            cctx = _zstd_pool.acquire(*self.params)
+            # content size in frame header: one-shot decompressors (zstd package) require it
+            size = _input_length(self.prev)
+            self.compr = cctx.compressobj(size=-1 if size is None else size)
+            yield from super().gen()
+            _zstd_pool.release(cctx, *self.params)
+
+    class ZstdDecompressorStream(DecompStream):
         def __init__(self, prev_stream):
-            super().__init__(prev_stream, zstd.decompress)
+            super().__init__(prev_stream, MultiFrameDecompressor(
+                lambda: zstandard.ZstdDecompressor(dict_data=zstd_dict).decompressobj()))
 
     stream_map["zstd"] = (".zstd", ZstdCompressorStream, ZstdDecompressorStream)
 
 except ImportError:
     pass
 
+if "zstd" not in stream_map:
+    try:
+        import zstd
+
+        class ZstdCompressorStream(SimpleFilterStream):   # type: ignore
+            def __init__(self, prev_stream):
+                super().__init__(prev_stream, zstd.compress)
+
+        class ZstdDecompressorStream(SimpleFilterStream):   # type: ignore
+            def __init__(self, prev_stream):
+                super().__init__(prev_stream, zstd.decompress)
+
+        stream_map["zstd"] = (".zstd", ZstdCompressorStream, ZstdDecompressorStream)
+
+    except ImportError:
+        pass
+
 try:
     import lz4.frame
 
-    # lz4.frame.LZ4FrameCompressor does not work?
-    class Lz4CompressorStream(SimpleFilterStream):
-        def __init__(self, prev_stream):
-            super().__init__(prev_stream, lz4.frame.compress)
+    _lz4_pool = CompressorPool(lz4.frame.LZ4FrameCompressor)
 
-    # lz4.frame.LZ4FrameDecompressor does not work?
-    class Lz4DecompressorStream(SimpleFilterStream):
+    class Lz4CompressorStream(Stream):
+        def gen(self):
+            # LZ4FrameCompressor can begin() again after flush()
+            compr = _lz4_pool.acquire()
+            yield compr.begin()
+            yield from filter(None, map(compr.compress, self.prev.gen()))
+            yield compr.flush()
+            _lz4_pool.release(compr)
+
+    class Lz4DecompressorStream(DecompStream):
         def __init__(self, prev_stream):
-            super().__init__(prev_stream, lz4.frame.decompress)
+            super().__init__(prev_stream, MultiFrameDecompressor(lz4.frame.LZ4FrameDecompressor))
 
     stream_map["lz4"] = (".lz4", Lz4CompressorStream, Lz4DecompressorStream)
 
@@ -261,9 +715,10 @@ try:
             self.compr = brotli.Compressor()
 
         def gen(self):
-            for i in self.prev.gen():
-                yield self.compr.process(i)
-            yield self.compr.flush()
+            yield from filter(None, map(self.compr.process, self.prev.gen()))
+            # finish(), not flush(): write last block marker
+            if tail := self.compr.finish():
+                yield tail
 
     class BrotliDecompressorStream(Stream):
         def __init__(self, prev_stream):
@@ -271,8 +726,7 @@ try:
             self.decompr = brotli.Decompressor()
 
         def gen(self):
-            for i in self.prev.gen():
-                yield self.decompr.process(i)
+            yield from filter(None, map(self.decompr.process, self.prev.gen()))
 
     stream_map["brotli"] = (".br", BrotliCompressorStream, BrotliDecompressorStream)
 
@@ -355,45 +809,151 @@ except ImportError:
 
 
 try:
-    import zlib_ng.gzip_ng   # type: ignore
+    import zlib_ng.zlib_ng   # type: ignore
 
-    class ZlibNgCompressorStream(SimpleFilterStream):
+    class ZlibNgCompressorStream(GzipCompressorStream):
         def __init__(self, prev_stream):
-            super().__init__(prev_stream, zlib_ng.gzip_ng.compress)
+            super().__init__(prev_stream, zlib_ng.zlib_ng)
 
-    class ZlibNgDecompressorStream(SimpleFilterStream):
+    class ZlibNgDecompressorStream(GzipDecompressorStream):
         def __init__(self, prev_stream):
-            super().__init__(prev_stream, zlib_ng.gzip_ng.decompress)
+            super().__init__(prev_stream, zlib_ng.zlib_ng)
 
     stream_map["zlib-ng"] = ("", ZlibNgCompressorStream, ZlibNgDecompressorStream)
 except ImportError:
     pass
 
-stream_ext: dict[str, tuple[str, type[Stream], type[Stream]]] = {v[0]: (k, *v[1:]) for k, v in stream_map.items()}
-stream_compress_modes = list(stream_map.keys()) + ["decompress", "raw"]
+# all codecs are registered: share read-only views of the registry
+stream_map = types.MappingProxyType(stream_map)   # type: ignore
+# modes without extension (zlib-ng) cannot be detected from file name
+stream_ext: Mapping[str, tuple[str, type[Stream], type[Stream]]] = types.MappingProxyType({
+    v[0]: (k, *v[1:]) for k, v in stream_map.items() if v[0]})
+stream_compress_modes = list(stream_map.keys()) + ["decompress", "raw", "auto"]
+auto_threshold = 1024*1024
+# codecs which accept memoryview chunks (from MmapReadStream) as input
+# (not SimpleFilterStream fallbacks, such as zstd package: their functions require bytes)
+mmap_modes = {k for k in ("gzip", "bzip2", "xz", "lzma", "zstd", "lz4", "brotli", "zlib-ng")
+              if k in stream_map and not issubclass(stream_map[k][1], SimpleFilterStream)}
+
+
+# codecs which compress in multiple threads (threads argument of compressor stream)
+thread_modes = {k for k in ("gzip", "bzip2", "xz", "zstd")
+                if k in stream_map and not issubclass(stream_map[k][1], SimpleFilterStream)}
+
+
+def split_stream_ext(name: str) -> tuple[str, Optional[tuple[str, type[Stream], type[Stream]]]]:
+    """
+    split compressed extension from file name
+
+    returns: (name without extension, stream_ext entry), or (name, None) if not compressed
+    """
+    pos = name.rfind(".")
+    if pos > 0 and name[pos-1] != "/":
+        ent = stream_ext.get(name[pos:])
+        if ent is not None:
+            return name[:pos], ent
+    return name, None
+
+
+def _auto_mode(ifname: pathlib.Path, size: Optional[int], remote: bool) -> str:
+    """
+    mode for "auto": keep compressed input, lz4 for large input to remote (S3), otherwise raw
+    """
+    ent = split_stream_ext(str(ifname))[1]
+    if ent is not None:
+        return ent[0]
+    if not remote or "lz4" not in stream_map:
+        return "raw"
+    if size is None or size >= auto_threshold:
+        return "lz4"
+    return "raw"
+
+
+def _input_size(ifname: pathlib.Path, ifp: Optional[Stream]) -> Optional[int]:
+    if ifp is None:
+        return ifname.stat().st_size
+    if isinstance(ifp, S3GetStream):
+        return ifp.obj.get("ContentLength")
+    if isinstance(ifp, S3RangedGetStream):
+        return ifp.size
+    return None
 
 
-def auto_compress_stream(ifname: pathlib.Path, mode: str, ifp: Optional[Stream] = None) -> tuple[os.PathLike, Stream]:
+def compressed_name(ifname: pathlib.Path, mode: str, size: Optional[int] = None,
+                    remote: bool = False) -> pathlib.Path:
+    """
+    output name of auto_compress_stream, without reading input
+
+    args:
+        size: input size, used by "auto" mode
+        remote: output goes to network (S3), used by "auto" mode
+    """
+    if mode == "auto":
+        mode = _auto_mode(ifname, size, remote)
+    base, ent = split_stream_ext(str(ifname))
+    if mode == "raw" or (ent is not None and ent[0] == mode):
+        return ifname
+    if mode in stream_map:
+        return pathlib.Path(base + stream_map[mode][0])
+    return pathlib.Path(base)
+
+
+def _first_mode(mode: str, ent: Optional[tuple]) -> Optional[str]:
+    """mode of the first stream reading input file"""
+    if mode == "raw":
+        return None
+    if ent is not None:
+        return ent[0] if ent[0] != mode else None
+    return mode if mode in stream_map else None
+
+
+def _file_stream(ifname: pathlib.Path, first_mode: Optional[str]) -> Stream:
+    """
+    open local file, memory-mapped if first (de)compressor accepts memoryview
+    """
+    fp = ifname.open('br')
+    if first_mode in mmap_modes:
+        try:
+            with fp:
+                return MmapReadStream(fp)
+        except (ValueError, OSError):
+            # empty file, pipe, ...
+            fp = ifname.open('br')
+    return FileReadStream(fp)
+
+
+def auto_compress_stream(ifname: pathlib.Path, mode: str, ifp: Optional[Stream] = None,
+                         threads: Optional[int] = None, remote: bool = False) -> tuple[os.PathLike, Stream]:
+    """
+    (de)compress ifname (or ifp) to mode
+
+    args:
+        threads: compress threads (thread_modes only), default: compress_threads or all cpus
+        remote: output goes to network (S3). "auto" mode compresses large input with lz4 only if remote
+    """
+    if mode == "auto":
+        mode = _auto_mode(ifname, _input_size(ifname, ifp), remote)
+    base, ent = split_stream_ext(str(ifname))
     if ifp is None:
-        ifp = FileReadStream(ifname.open('br'))
+        ifp = _file_stream(ifname, _first_mode(mode, ent))
     if mode == "raw":
         return ifname, ifp
-    base, ext = os.path.splitext(str(ifname))
+    if isinstance(ifp, S3GetStream):
+        # fetch next chunk from network while (de)compressing current one
+        ifp = PrefetchStream(ifp)
     # decompress
     res: Stream = ifp
-    if ext in stream_ext:
-        imode, _, dst = stream_ext[ext]
+    if ent is not None:
+        imode, _, dst = ent
         if imode == mode:
             return ifname, res
         _log.debug("input mode: %s", imode)
         res = dst(res)
-    else:
-        base = str(ifname)
     if mode == "decompress":
         return pathlib.Path(base), res
     # compress
     if mode in stream_map:
         ext, cst, _ = stream_map[mode]
-        res = cst(res)
+        res = cst(res, threads=threads) if threads and mode in thread_modes else cst(res)
         base = base + ext
     return pathlib.Path(base), res
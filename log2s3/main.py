@@ -5,16 +5,19 @@ import datetime
 import shlex
 import subprocess
 import functools
+import contextlib
+import itertools
+import operator
+import collections
 import click
 import json
 import pathlib
-import boto3
 import io
-from typing import Union, Generator, Optional
+from typing import Union, Generator, Optional, Iterable
 from .version import VERSION
 from .common_stream import Stream, MergeStream
-from .compr_stream import S3GetStream, S3PutStream, \
-    auto_compress_stream, stream_compress_modes
+from .compr_stream import S3PutStream, s3_get_stream, RawReadStream, \
+    auto_compress_stream, compressed_name, stream_compress_modes, split_stream_ext
 try:
     from mypy_boto3_s3.client import S3Client as S3ClientType
 except ImportError:
@@ -47,12 +50,43 @@ def arg_mask(d: Union[list, dict]) -> Union[list, dict]:
 
 @click.group(invoke_without_command=True)
 @click.version_option(VERSION)
+@click.option("--zstd-dict", envvar="LOG2S3_ZSTD_DICT", type=click.Path(file_okay=True, dir_okay=False, exists=True),
+              help="trained zstd dictionary (see zstd-train)")
+@click.option("--threads", envvar="LOG2S3_THREADS", type=click.IntRange(1),
+              help="compress threads of gzip/bzip2/xz/zstd (default: all cpus)")
 @click.pass_context
-def cli(ctx):
+def cli(ctx, zstd_dict, threads):
+    from . import compr_stream
+    # set or reset on every invocation: do not leak into later runs in the same process (tests)
+    compr_stream.compress_threads = threads
+    if zstd_dict:
+        try:
+            from .compr_stream import set_zstd_dict
+        except ImportError:
+            raise click.UsageError("--zstd-dict requires the zstandard package")
+        set_zstd_dict(pathlib.Path(zstd_dict).read_bytes())
+    elif getattr(compr_stream, "zstd_dict", None) is not None:
+        compr_stream.set_zstd_dict(None)
     if ctx.invoked_subcommand is None:
         print(ctx.get_help())
 
 
+s3_client_options = {
+    "retries": {"max_attempts": 10, "mode": "adaptive"},
+    "tcp_keepalive": True,
+}
+
+
+@functools.lru_cache(maxsize=8)
+def _s3_client(max_pool_connections: int, **args) -> S3ClientType:
+    """S3 client, shared by commands with same options (e.g. tasks of ible-playbook)"""
+    # boto3 is slow to import, load only for S3 commands
+    import boto3
+    from botocore.config import Config
+    config = Config(max_pool_connections=max_pool_connections, **s3_client_options)
+    return boto3.client('s3', config=config, **args)
+
+
 def s3_option(func):
     @click.option("--s3-access-key", envvar="AWS_ACCESS_KEY_ID", help="AWS Access Key")
     @click.option("--s3-secret-key", envvar="AWS_SECRET_ACCESS_KEY", help="AWS Secret Key")
@@ -76,11 +110,36 @@ def s3_option(func):
         empty_keys = {k for k, v in args.items() if v is None}
         for k in empty_keys:
             args.pop(k)
-        s3 = boto3.client('s3', **args)
+        # enough connections for parallel part uploads (s3_transfer_option) and ranged downloads
+        # of all objects in progress (--jobs), avoid "connection pool is full"
+        from .compr_stream import s3_ranged_concurrency
+        jobs = int(kwargs.get("jobs") or 1)
+        per_object = _s3_object_concurrency(kwargs.get("s3_concurrency"), jobs) + s3_ranged_concurrency
+        s3 = _s3_client(max(32, jobs * per_object), **args)
         return func(s3=s3, bucket_name=s3_bucket, **kwargs)
     return _
 
 
+def _s3_object_concurrency(s3_concurrency, jobs: int) -> int:
+    """part uploads of each object, when `jobs` objects are uploaded at the same time"""
+    return max(1, int(s3_concurrency or 1) // jobs)
+
+
+def s3_transfer_option(func):
+    """--s3-concurrency for upload commands, passed as transfer_config. use with (below) s3_option"""
+    from .compr_stream import s3_transfer_options
+
+    @click.option("--s3-concurrency", envvar="LOG2S3_S3_CONCURRENCY", type=click.IntRange(1),
+                  default=s3_transfer_options["max_concurrency"], show_default=True,
+                  help="max parallel part uploads (shared by --jobs objects)")
+    @functools.wraps(func)
+    def _(s3_concurrency, **kwargs):
+        from .compr_stream import s3_transfer_config
+        concurrency = _s3_object_concurrency(s3_concurrency, int(kwargs.get("jobs") or 1))
+        return func(transfer_config=s3_transfer_config(concurrency), **kwargs)
+    return _
+
+
 compress_option = click.option(
     "--compress", default="gzip", type=click.Choice(stream_compress_modes),
     help="compress type", show_default=True)
@@ -175,30 +234,55 @@ def s3_bucket(s3: S3ClientType, bucket_name: str):
         click.echo("%s %s" % (bkt["CreationDate"], bkt["Name"]))
 
 
-def allobjs(s3: S3ClientType, bucket_name: str, prefix: str, marker: str = ''):
-    res = s3.list_objects(Bucket=bucket_name, Prefix=prefix, Marker=marker)
-    ct = res.get('Contents', [])
-    yield from ct
-    if res.get("IsTruncated") and len(ct) != 0:
-        mk = ct[-1].get('Key')
-        if mk:
-            yield from allobjs(s3, bucket_name=bucket_name, prefix=prefix, marker=mk)
+def allobjs(s3: S3ClientType, bucket_name: str, prefix: str):
+    args = {"Bucket": bucket_name, "Prefix": prefix}
+    while True:
+        res = s3.list_objects_v2(**args)
+        yield from res.get('Contents', [])
+        token = res.get("NextContinuationToken")
+        if not res.get("IsTruncated") or not token:
+            break
+        args["ContinuationToken"] = token
 
 
-def s3obj2stat(obj: dict) -> os.stat_result:
-    ts = obj.get("LastModified", datetime.datetime.now()).timestamp()
-    sz = obj.get("Size", 0)
-    return os.stat_result((0o644, 0, 0, 0, 0, 0, sz, ts, ts, ts))
+def delete_keys(s3: S3ClientType, bucket_name: str, keys: Iterable[str], dry: bool = False) -> int:
+    """delete keys as they come, returns number of keys"""
+    count = 0
+    # DeleteObjects accepts up to 1000 keys per request
+    for batch in itertools.batched(keys, 1000):
+        count += len(batch)
+        if dry:
+            _log.info("(dry)remove objects: %s", batch)
+            continue
+        # quiet: response contains errors only
+        res = s3.delete_objects(Bucket=bucket_name, Delete={"Objects": [{"Key": x} for x in batch], "Quiet": True})
+        for err in res.get("Errors", []):
+            _log.warning("cannot remove %s: %s", err.get("Key"), err.get("Message"))
+    return count
+
+
+def ordered_map(fn, items: Iterable, jobs: int) -> Generator:
+    """fn(item) in thread pool, yield results in order of items. at most `jobs` calls are pending"""
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max(1, jobs)) as executor:
+        pending: collections.deque = collections.deque()
+        for i in items:
+            pending.append(executor.submit(fn, i))
+            if len(pending) >= jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def allobjs_conf(s3: S3ClientType, bucket_name: str, prefix: str, config: dict):
     _log.debug("allobjs: bucket=%s, prefix=%s, config=%s", bucket_name, prefix, config)
-    from .processor import DebugProcessor
+    from .processor import DebugProcessor, S3Stat
     dummy = DebugProcessor(config)
     suffix = config.get("suffix", "")
-    objs = allobjs(s3, bucket_name, prefix)
-    return filter(lambda x: x["Key"].endswith(suffix) and
-                  dummy.check(pathlib.Path(x["Key"]), s3obj2stat(x)), objs)
+    # bind once: no attribute lookup per object
+    check, to_stat = dummy.check, S3Stat.from_obj
+    return (x for x in allobjs(s3, bucket_name, prefix)
+            if x["Key"].endswith(suffix) and check(x["Key"], to_stat(x)))
 
 
 @cli.command()
@@ -222,35 +306,34 @@ def s3_list(s3: S3ClientType, bucket_name: str, config: dict, top: pathlib.Path)
 @verbose_option
 def s3_du(s3: S3ClientType, bucket_name: str, config: dict, top: pathlib.Path, summary: bool, pathsep: str):
     """show S3 directory usage"""
-    out = {}
+    # name -> [count, size]
+    out: collections.defaultdict[str, list[int]] = collections.defaultdict(lambda: [0, 0])
     for i in allobjs_conf(s3, bucket_name, str(top).lstrip("/"), config):
         key = i["Key"]
-        ks = key.rsplit(pathsep, 1)
-        dirname = ks[0]
+        dirname, sep, _ = key.rpartition(pathsep)
+        if not sep:
+            dirname = key
         sz = i["Size"]
-        if dirname not in out:
-            out[dirname] = [0, 0]
-        out[dirname][0] += 1
-        out[dirname][1] += sz
+        acc = out[dirname]
+        acc[0] += 1
+        acc[1] += sz
+        if summary:
+            # add to every ancestor directory in the same pass
+            pos = dirname.find(pathsep)
+            while pos != -1:
+                acc = out[dirname[:pos]]
+                acc[0] += 1
+                acc[1] += sz
+                pos = dirname.find(pathsep, pos + 1)
     if len(out) == 0:
         click.echo("(empty result)")
         return
-    if summary:
-        for korig in list(out.keys()):
-            k = korig
-            while len(k) != 0:
-                k0 = k.rsplit(pathsep, 1)
-                if len(k0) == 1:
-                    break
-                k = k0[0]
-                if k not in out:
-                    out[k] = [0, 0]
-                out[k][0] += out[korig][0]
-                out[k][1] += out[korig][1]
     click.echo("%10s %5s %s" % ("size", "cnt", "name"))
     click.echo("----------+-----+-----------------------")
-    for k, v in sorted(out.items(), key=lambda f: f[1][1], reverse=True):
-        click.echo("%10d %5d %s" % (v[1], v[0], k))
+    # click.echo flushes on every call: write the table at once
+    rows = [(v[1], v[0], k) for k, v in out.items()]
+    rows.sort(key=operator.itemgetter(0), reverse=True)
+    click.echo("\n".join(["%10d %5d %s" % x for x in rows]))
 
 
 @cli.command()
@@ -260,15 +343,14 @@ def s3_du(s3: S3ClientType, bucket_name: str, config: dict, top: pathlib.Path, s
 @click.option("--dry/--wet", help="dry run or wet run", default=False, show_default=True)
 def s3_delete_by(s3: S3ClientType, bucket_name: str, top: pathlib.Path, config: dict, dry: bool):
     """delete S3 objects"""
-    del_keys = [x["Key"] for x in allobjs_conf(s3, bucket_name, str(top).lstrip("/"), config)]
-    if len(del_keys) == 0:
+    del_keys = (x["Key"] for x in allobjs_conf(s3, bucket_name, str(top).lstrip("/"), config))
+    count = delete_keys(s3, bucket_name, del_keys, dry)
+    if count == 0:
         _log.info("no object found")
     elif dry:
-        _log.info("(dry)remove objects: %s", del_keys)
-        click.echo(f"(dry)remove {len(del_keys)} objects")
+        click.echo(f"(dry)remove {count} objects")
     else:
-        _log.info("(wet)remove %s objects", len(del_keys))
-        s3.delete_objects(Bucket=bucket_name, Delete={"Objects": [{"Key": x} for x in del_keys]})
+        _log.info("(wet)removed %s objects", count)
 
 
 @cli.command()
@@ -296,35 +378,48 @@ def s3_diff(s3: S3ClientType, bucket_name: str, prefix: str, top: pathlib.Path,
 
 @cli.command()
 @s3_option
+@s3_transfer_option
 @s3tree_option
 @verbose_option
 @compress_option
 @click.option("--dry/--wet", help="dry run or wet run", default=False, show_default=True)
 @click.option("--keep/--remove", help="keep old file or delete", default=True, show_default=True)
+@click.option("--jobs", type=click.IntRange(1), default=8, show_default=True,
+              help="number of objects processed in parallel")
 def s3_compress_tree(s3: S3ClientType, bucket_name: str, config: dict, top: pathlib.Path,
-                     compress: str, dry: bool, keep: bool):
+                     compress: str, dry: bool, keep: bool, jobs: int, transfer_config):
     """compress S3 objects"""
     topstr = str(top)
     if topstr == ".":
         topstr = ""
-    for i in allobjs_conf(s3, bucket_name, topstr.lstrip("/"), config):
-        rd = S3GetStream(s3, bucket=bucket_name, key=i["Key"])
-        newname, data = auto_compress_stream(pathlib.Path(i["Key"]), compress, rd)
-        if newname == i["Key"]:
-            _log.debug("do nothing: %s", i["Key"])
-            continue
-        if dry:
-            new_length = sum([len(x) for x in data.gen()])
-            _log.info("(dry) recompress %s -> %s (%s->%s)", i["Key"], newname, i["Size"], new_length)
-        else:
-            ps = S3PutStream(data, s3, bucket=bucket_name, key=str(newname))
-            for _ in ps.gen():
-                pass
-            res = s3.head_object(Bucket=bucket_name, Key=str(newname))
-            _log.info("(wet) recompress %s -> %s (%s->%s)", i["Key"], newname, i["Size"], res["ContentLength"])
-            if not keep:
-                _log.info("remove old %s (->%s)", i["Key"], newname)
-                s3.delete_object(Bucket=bucket_name, Key=i["Key"])
+    jobs = int(jobs)
+    # compress threads and part uploads (transfer_config) are shared by jobs
+    fn = functools.partial(_s3_recompress, s3, bucket_name, compress=compress, dry=dry, keep=keep,
+                           transfer_config=transfer_config, threads=_job_threads(jobs) if jobs > 1 else None)
+    for _ in ordered_map(fn, allobjs_conf(s3, bucket_name, topstr.lstrip("/"), config), jobs):
+        pass
+
+
+def _s3_recompress(s3: S3ClientType, bucket_name: str, obj: dict, compress: str, dry: bool, keep: bool,
+                   transfer_config=None, threads: Optional[int] = None):
+    newname = compressed_name(pathlib.Path(obj["Key"]), compress, obj["Size"], remote=True)
+    if str(newname) == obj["Key"]:
+        _log.debug("do nothing: %s", obj["Key"])
+        return
+    rd = s3_get_stream(s3, bucket_name, obj["Key"], obj["Size"], obj.get("ETag"))
+    _, data = auto_compress_stream(pathlib.Path(obj["Key"]), compress, rd, threads=threads, remote=True)
+    if dry:
+        new_length = sum([len(x) for x in data.gen()])
+        _log.info("(dry) recompress %s -> %s (%s->%s)", obj["Key"], newname, obj["Size"], new_length)
+    else:
+        ps = S3PutStream(data, s3, bucket=bucket_name, key=str(newname), transfer_config=transfer_config)
+        for _ in ps.gen():
+            pass
+        res = s3.head_object(Bucket=bucket_name, Key=str(newname))
+        _log.info("(wet) recompress %s -> %s (%s->%s)", obj["Key"], newname, obj["Size"], res["ContentLength"])
+        if not keep:
+            _log.info("remove old %s (->%s)", obj["Key"], newname)
+            s3.delete_object(Bucket=bucket_name, Key=obj["Key"])
 
 
 @cli.command()
@@ -357,18 +452,30 @@ def filetree_list(top: pathlib.Path, config: dict):
         click.echo("%10s %19s %s" % (sz, tmstr, p))
 
 
+def _job_threads(jobs: int) -> int:
+    """compress threads of each job, when `jobs` streams are compressed at the same time"""
+    from .compr_stream import compress_threads
+    return max(1, (compress_threads or os.cpu_count() or 1) // jobs)
+
+
 @cli.command()
 @filetree_option
 @compress_option
+@click.option("--jobs", type=click.IntRange(1), default=1, show_default=True,
+              help="number of files compressed in parallel")
 @verbose_option
-def filetree_compress(top: pathlib.Path, config: dict, compress):
+def filetree_compress(top: pathlib.Path, config: dict, compress, jobs: int):
     """compress files"""
     if compress:
         config["compress"] = compress
+    jobs = int(jobs)
+    if jobs > 1:
+        # share cpus between files, not jobs x all cpus threads
+        config["threads"] = _job_threads(jobs)
     from .processor import CompressProcessor, process_walk
     cproc = CompressProcessor(config)
     proc = [cproc]
-    process_walk(top, proc)
+    process_walk(top, proc, jobs)
     _log.info("compressed=%d, skipped=%d, size=%d->%d (%d bytes)",
               cproc.processed, cproc.skipped, cproc.before_total, cproc.after_total,
               cproc.before_total-cproc.after_total)
@@ -390,6 +497,7 @@ def filetree_delete(top: pathlib.Path, config: dict):
 @verbose_option
 def merge(files: list[click.Path]):
     """merge sorted log files"""
+    from .processor import walk_files
     input_stream: list[Stream] = []
     for fn in files:
         p = pathlib.Path(str(fn))
@@ -397,29 +505,57 @@ def merge(files: list[click.Path]):
             _, ch = auto_compress_stream(p, "decompress")
             input_stream.append(ch)
         elif p.is_dir():
-            for proot, _, pfiles in p.walk():
-                for pfn in pfiles:
-                    _, ch = auto_compress_stream(proot / pfn, "decompress")
-                    input_stream.append(ch)
+            for ent in walk_files(p):
+                _, ch = auto_compress_stream(pathlib.Path(ent.path), "decompress")
+                input_stream.append(ch)
         else:
             _log.warning("%s is not a directory or file", p)
 
-    for i in MergeStream(input_stream).text_gen():
-        click.echo(i, nl=False)
+    # heapq.merge of lines, written in large chunks
+    for d in MergeStream(input_stream).gen():
+        sys.stdout.buffer.write(d)
+
+
+class ExistingKeys:
+    """
+    `key in ExistingKeys(...)` checks object by HEAD request, instead of listing all objects
+    """
+
+    def __init__(self, s3: S3ClientType, bucket_name: str):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+
+    def __contains__(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.s3.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
 
 
 @cli.command()
 @s3_option
+@s3_transfer_option
 @click.option("--prefix", default='', help="AWS S3 Object Prefix")
+@click.option("--head/--list", "head_check", default=False, show_default=True,
+              help="find existing objects by HEAD per file, or by listing prefix")
 @filetree_option
 @compress_option
 @verbose_option
-def s3_put_tree(s3: S3ClientType, bucket_name: str, prefix: str, top: pathlib.Path, config: dict, compress):
+def s3_put_tree(s3: S3ClientType, bucket_name: str, prefix: str, top: pathlib.Path, config: dict, compress,
+                head_check: bool, transfer_config):
     """compress and put log files to S3"""
     config["s3"] = s3
     config["s3_bucket"] = bucket_name
     config["s3_prefix"] = prefix
-    config["skip_names"] = {x["Key"] for x in allobjs(s3, bucket_name, prefix)}
+    if head_check:
+        config["skip_names"] = ExistingKeys(s3, bucket_name)
+    else:
+        config["skip_names"] = frozenset(x["Key"] for x in allobjs(s3, bucket_name, prefix))
+    config["transfer_config"] = transfer_config
     config["compress"] = compress
     from .processor import S3Processor, process_walk
     proc = [S3Processor(config)]
@@ -429,34 +565,45 @@ def s3_put_tree(s3: S3ClientType, bucket_name: str, prefix: str, top: pathlib.Pa
 
 @cli.command()
 @s3_option
+@s3_transfer_option
 @click.option("--key", required=True, help="AWS S3 Object Key")
 @click.argument("filename", type=click.Path(file_okay=True, dir_okay=False, exists=True))
 @compress_option
 @verbose_option
-def s3_put1(s3: S3ClientType, bucket_name: str, key: str, filename: str, compress: str):
+def s3_put1(s3: S3ClientType, bucket_name: str, key: str, filename: str, compress: str, transfer_config):
     """put 1 file to S3"""
     from .compr_stream import S3PutStream, auto_compress_stream
     input_path = pathlib.Path(filename)
-    _, st = auto_compress_stream(input_path, compress)
-    ost = S3PutStream(st, s3, bucket_name, key)
+    _, st = auto_compress_stream(input_path, compress, remote=True)
+    ost = S3PutStream(st, s3, bucket_name, key, transfer_config=transfer_config)
     for _ in ost.gen():
         pass
 
 
 def _s3_read_stream(s3: S3ClientType, bucket_name: str, key: str) -> Stream:
-    res = S3GetStream(s3, bucket=bucket_name, key=key)
+    res = s3_get_stream(s3, bucket_name, key)
     _, res = auto_compress_stream(pathlib.Path(key), "decompress", res)
     return res
 
 
+# number of objects requested ahead by s3-cat
+s3_read_ahead = 8
+
+
+def _s3_read_streams(s3: S3ClientType, bucket_name: str, keys: list[str], ahead: int) -> Generator[Stream, None, None]:
+    """open objects in thread pool (at most `ahead` ahead of consumer), yield streams in order of keys"""
+    yield from ordered_map(functools.partial(_s3_read_stream, s3, bucket_name), keys, min(ahead, len(keys)))
+
+
 @cli.command()
 @s3_option
 @click.argument("keys", nargs=-1)
 @verbose_option
 def s3_cat(s3: S3ClientType, bucket_name: str, keys: list[str]):
     """concatinate compressed objects"""
-    for key in keys:
-        for d in _s3_read_stream(s3, bucket_name, key).gen():
+    # send GET requests of next objects while writing current one
+    for st in _s3_read_streams(s3, bucket_name, keys, s3_read_ahead):
+        for d in st.gen():
             sys.stdout.buffer.write(d)
 
 
@@ -478,6 +625,15 @@ def s3_less(s3: S3ClientType, bucket_name: str, key: str):
     _data_via_pager(_s3_read_stream(s3, bucket_name, key))
 
 
+def _recompress_fn(name: str):
+    """returns function to compress edited data back to the format of `name`"""
+    _, ent = split_stream_ext(name)
+    if ent is None:
+        return lambda f: f
+    compress_st = ent[1]
+    return lambda f: compress_st(RawReadStream(f)).read_all()
+
+
 @cli.command()
 @s3_option
 @click.argument("key")
@@ -486,14 +642,7 @@ def s3_less(s3: S3ClientType, bucket_name: str, key: str):
 def s3_vi(s3: S3ClientType, bucket_name: str, key: str, dry):
     """edit compressed object and overwrite"""
     bindata = _s3_read_stream(s3, bucket_name, key).read_all().decode("utf-8")
-    from .compr_stream import stream_ext, RawReadStream
-    _, ext = os.path.splitext(key)
-    if ext in stream_ext:
-        def compress_fn(f: bytes) -> bytes:
-            compress_st = stream_ext[ext][1]
-            return compress_st(RawReadStream(f)).read_all()
-    else:
-        def compress_fn(f: bytes) -> bytes: return f
+    compress_fn = _recompress_fn(key)
     newdata = click.edit(text=bindata)
     if newdata is not None and newdata != bindata:
         wr = compress_fn(newdata.encode("utf-8"))
@@ -512,12 +661,19 @@ def s3_vi(s3: S3ClientType, bucket_name: str, key: str, dry):
 @verbose_option
 def s3_merge(s3: S3ClientType, bucket_name: str, keys: list[str]):
     """merge sorted log objects"""
-    input_stream: list[Stream] = []
-    for key in keys:
-        input_stream.append(_s3_read_stream(s3, bucket_name, key))
+    # all objects are read at the same time
+    input_stream: list[Stream] = list(_s3_read_streams(s3, bucket_name, keys, min(32, len(keys))))
+
+    # heapq.merge of lines, written in large chunks
+    for d in MergeStream(input_stream).gen():
+        sys.stdout.buffer.write(d)
 
-    for i in MergeStream(input_stream).text_gen():
-        click.echo(i, nl=False)
+
+def _s3_heads(s3: S3ClientType, bucket_name: str, keys: list[str]) -> Generator[tuple[str, dict], None, None]:
+    """head objects in thread pool, yield (key, response) in order of keys"""
+    def head(key: str):
+        return key, s3.head_object(Bucket=bucket_name, Key=key)
+    yield from ordered_map(head, keys, min(32, len(keys)))
 
 
 @cli.command()
@@ -527,14 +683,13 @@ def s3_merge(s3: S3ClientType, bucket_name: str, keys: list[str]):
 @verbose_option
 def s3_del(s3: S3ClientType, bucket_name: str, keys: list[str], dry):
     """delete objects"""
-    for k in keys:
-        res = s3.head_object(Bucket=bucket_name, Key=k)
+    for k, res in _s3_heads(s3, bucket_name, keys):
         click.echo("%s %s %s" % (res["LastModified"], res["ContentLength"], k))
     if dry:
         _log.info("(dry) delete %s keys", len(keys))
     else:
         _log.info("(wet) delete %s keys", len(keys))
-        s3.delete_objects(Bucket=bucket_name, Delete={"Objects": [{"Key": x} for x in keys]})
+        delete_keys(s3, bucket_name, keys)
 
 
 @cli.command()
@@ -543,8 +698,7 @@ def s3_del(s3: S3ClientType, bucket_name: str, keys: list[str], dry):
 @verbose_option
 def s3_head(s3: S3ClientType, bucket_name: str, keys: list[str]):
     """delete objects"""
-    for k in keys:
-        res = s3.head_object(Bucket=bucket_name, Key=k)
+    for k, res in _s3_heads(s3, bucket_name, keys):
         click.echo(f"{k} = {res}")
 
 
@@ -590,16 +744,9 @@ def view_file(filename: str):
 @verbose_option
 def edit_file(filename: str, dry):
     """edit compressed file and overwrite"""
-    from .compr_stream import stream_ext, RawReadStream
     fname = pathlib.Path(filename)
     _, data = auto_compress_stream(fname, "decompress")
-    _, ext = os.path.splitext(fname)
-    if ext in stream_ext:
-        def compress_fn(f: bytes) -> bytes:
-            compress_st = stream_ext[ext][1]
-            return compress_st(RawReadStream(f)).read_all()
-    else:
-        def compress_fn(f: bytes) -> bytes: return f
+    compress_fn = _recompress_fn(filename)
     bindata = data.read_all().decode('utf-8')
     newdata = click.edit(text=bindata)
     if newdata is not None and newdata != bindata:
@@ -613,10 +760,74 @@ def edit_file(filename: str, dry):
         _log.info("not changed")
 
 
+@cli.command()
+@click.argument("files", type=click.Path(file_okay=True, dir_okay=True, exists=True, readable=True), nargs=-1)
+@click.option("--output", type=click.Path(file_okay=True, dir_okay=False), required=True, help="dictionary file")
+@click.option("--size", type=int, default=112640, show_default=True, help="dictionary size")
+@verbose_option
+def zstd_train(files: list[click.Path], output: str, size: int):
+    """train zstd dictionary from sample log files"""
+    try:
+        from .compr_stream import train_zstd_dict
+    except ImportError:
+        raise click.UsageError("zstd-train requires the zstandard package")
+    from .processor import walk_files
+    samples: list[bytes] = []
+    for fn in files:
+        p = pathlib.Path(str(fn))
+        targets = [p] if p.is_file() else [pathlib.Path(ent.path) for ent in walk_files(p)]
+        for t in targets:
+            _, ch = auto_compress_stream(t, "decompress")
+            samples.append(ch.read_all())
+    _log.info("train %d samples", len(samples))
+    pathlib.Path(output).write_bytes(train_zstd_dict(samples, size))
+
+
+@contextlib.contextmanager
+def _bench_input(file: str):
+    """memory-mapped file: benchmark input stays in page cache, not copied to memory"""
+    import mmap
+    with open(file, "rb") as fp:
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            yield fp.read()
+            return
+    with mm:
+        yield mm
+
+
+def _bench_digest(st: Stream) -> bytes:
+    import hashlib
+    h = hashlib.sha256()
+    for i in st.gen():
+        h.update(i)
+    return h.digest()
+
+
+def _bench_run(st: type[Stream], input_data, min_time: float = 0.2) -> tuple[int, float]:
+    """returns (number of runs, seconds)"""
+    import time
+    from .compr_stream import RawReadStream
+    # first run (with result check) is done by caller as warmup
+    # same minimum time as timeit.autorange, without its ramp-up runs
+    num = 0
+    t0 = time.perf_counter_ns()
+    deadline = t0 + int(min_time * 1e9)
+    while True:
+        for _ in st(RawReadStream(input_data)).gen():
+            pass
+        num += 1
+        t1 = time.perf_counter_ns()
+        if t1 >= deadline:
+            return num, (t1 - t0) / 1e9
+
+
 @cli.command()
 @click.argument("file")
-@click.option("--compress", default=None, type=click.Choice(list(set(stream_compress_modes)-{"raw", "decompress"})),
-              help="compress type (default: all)", multiple=True)
+@click.option("--compress", default=None, multiple=True, help="compress type (default: all)",
+              type=click.Choice(list(set(stream_compress_modes)-{"raw", "decompress", "auto"})))
 def compress_benchmark(compress, file):
     """benchmark compress algorithm
 
@@ -628,46 +839,38 @@ def compress_benchmark(compress, file):
         decompress: decompress throuput (original bytes/sec)
     """
     import csv
-    import timeit
-    from .compr_stream import stream_map, stream_compress_modes, RawReadStream, Stream
+    from .compr_stream import stream_map, stream_compress_modes
     if not compress:
         compress = stream_compress_modes
-    raw_data = pathlib.Path(file).read_bytes()
-
-    def bench_comp(input_data: bytes):
-        s1 = RawReadStream(input_data)
-        s2 = comp_st(s1)
-        for _ in s2.gen():
-            pass
-
-    def bench_decomp(input_data: bytes):
-        s1 = RawReadStream(input_data)
-        s2 = decomp_st(s1)
-        for _ in s2.gen():
-            pass
 
     wr = csv.writer(sys.stdout)
     wr.writerow(["mode", "rate", "compress", "decompress"])
-    for c in compress:
-        mode = c
-        m = stream_map.get(mode)
-        if not m:
-            click.Abort(f"no such compress mode: {mode}")
-            continue
-        comp_st: type[Stream] = m[1]
-        decomp_st: type[Stream] = m[2]
-        compressed_data = comp_st(RawReadStream(raw_data)).read_all()
-        assert raw_data == decomp_st(RawReadStream(compressed_data)).read_all()
-        isz = len(raw_data)
-        csz = len(compressed_data)
-        rate = csz/isz
-        cnum, csec = timeit.Timer(stmt='bench(input_data)', globals={
-            "input_data": raw_data, "comp_st": comp_st, "bench": bench_comp
-        }).autorange()
-        dnum, dsec = timeit.Timer(stmt='bench(input_data)', globals={
-            "input_data": compressed_data, "decomp_st": decomp_st, "bench": bench_decomp
-        }).autorange()
-        wr.writerow([str(x) for x in [mode, rate, isz*cnum/csec, isz*dnum/dsec]])
+    with _bench_input(file) as raw_data:
+        for mode in compress:
+            m = stream_map.get(mode)
+            if not m:
+                click.Abort(f"no such compress mode: {mode}")
+                continue
+            wr.writerow([str(x) for x in _bench_mode(mode, m[1], m[2], raw_data)])
+
+
+def _bench_mode(mode: str, comp_st: type[Stream], decomp_st: type[Stream], raw_data) -> list:
+    """returns [mode, rate, compress throughput, decompress throughput]"""
+    from .compr_stream import RawReadStream, mmap_modes
+    # memoryview: chunks of RawReadStream become zero-copy slices
+    # bytes: for codecs which read whole input
+    # views are released on return, before the mapping is closed
+    wrap = memoryview if mode in mmap_modes else bytes
+    input_data = wrap(raw_data)
+    compressed_data = wrap(comp_st(RawReadStream(input_data)).read_all())
+    # compare digests: do not hold decompressed copy
+    assert _bench_digest(RawReadStream(input_data)) == _bench_digest(decomp_st(RawReadStream(compressed_data)))
+    isz = len(raw_data)
+    csz = len(compressed_data)
+    rate = csz/isz
+    cnum, csec = _bench_run(comp_st, input_data)
+    dnum, dsec = _bench_run(decomp_st, compressed_data)
+    return [mode, rate, isz*cnum/csec, isz*dnum/dsec]
 
 
 @cli.command()
@@ -2,10 +2,14 @@ import os
 import pathlib
 import time
 import shutil
+import threading
+import collections
+import concurrent.futures
+import logging
 from logging import getLogger
-from typing import Optional, Sequence
+from typing import Optional, Sequence, Union, Generator, NamedTuple
 from abc import ABC, abstractmethod
-from .compr_stream import auto_compress_stream, FileWriteStream, S3PutStream
+from .compr_stream import auto_compress_stream, compressed_name, FileWriteStream, S3PutStream
 import pytimeparse
 import humanfriendly
 import datetime
@@ -18,70 +22,89 @@ except ImportError:
 _log = getLogger(__name__)
 
 
+class S3Stat(NamedTuple):
+    """size and mtime of S3 object, the part of os.stat_result used by FileProcessor.check"""
+    st_size: int
+    st_mtime: float
+
+    @classmethod
+    def from_obj(cls, obj: dict) -> "S3Stat":
+        """from an entry of list_objects_v2 Contents"""
+        lm = obj.get("LastModified")
+        return cls(obj.get("Size", 0), lm.timestamp() if lm is not None else time.time())
+
+
 class FileProcessor(ABC):
     def __init__(self, config: dict = {}):
         self.config = {k: v for k, v in config.items() if v is not None}
         self.processed = 0
         self.skipped = 0
+        self.lock = threading.Lock()
+        # parse conditions once, not for each file
+        self.older = pytimeparse.parse(self.config["older"]) if "older" in self.config else None
+        self.newer = pytimeparse.parse(self.config["newer"]) if "newer" in self.config else None
+        self.date_range = self._parse_date_range(self.config["date"]) if "date" in self.config else None
+        self.smaller = humanfriendly.parse_size(self.config["smaller"], True) if "smaller" in self.config else None
+        self.bigger = humanfriendly.parse_size(self.config["bigger"], True) if "bigger" in self.config else None
+
+    @staticmethod
+    def _parse_date_range(date: str) -> tuple[float, float]:
+        """"YYYY-mm-dd" or "from..to" to [from, to) in timestamp"""
+        if ".." in date:
+            fromdate, todate = [datetime.datetime.fromisoformat(x) for x in date.split("..", 1)]
+        else:
+            fromdate = datetime.datetime.fromisoformat(date)
+            todate = fromdate + datetime.timedelta(days=1)
+        return fromdate.timestamp(), todate.timestamp()
 
     def check_date_range(self, mtime: float) -> bool:
-        if "older" in self.config:
-            older = pytimeparse.parse(self.config["older"])
-            if older is not None and mtime > time.time()-older:
-                return False
-        if "newer" in self.config:
-            newer = pytimeparse.parse(self.config["newer"])
-            if newer is not None and mtime < time.time()-newer:
-                return False
-        if "date" in self.config:
-            mtime_datetime = datetime.datetime.fromtimestamp(mtime)
-            if ".." in self.config["date"]:
-                fromdate, todate = [datetime.datetime.fromisoformat(
-                    x) for x in self.config["date"].split("..", 1)]
-                if not fromdate <= mtime_datetime < todate:
-                    return False
-            else:
-                fromdate = datetime.datetime.fromisoformat(self.config["date"])
-                todate = fromdate + datetime.timedelta(days=1)
-                if not fromdate <= mtime_datetime < todate:
-                    return False
+        if self.older is not None and mtime > time.time()-self.older:
+            return False
+        if self.newer is not None and mtime < time.time()-self.newer:
+            return False
+        if self.date_range is not None and not self.date_range[0] <= mtime < self.date_range[1]:
+            return False
         return True
 
     def check_size_range(self, size: int) -> bool:
-        if "smaller" in self.config:
-            smaller = humanfriendly.parse_size(self.config["smaller"], True)
-            if size > smaller:
-                return False
-        if "bigger" in self.config:
-            bigger = humanfriendly.parse_size(self.config["bigger"], True)
-            if size < bigger:
-                return False
+        if self.smaller is not None and size > self.smaller:
+            return False
+        if self.bigger is not None and size < self.bigger:
+            return False
         return True
 
-    def check_name(self, fname: pathlib.Path) -> bool:
+    def check_name(self, fname: Union[pathlib.PurePath, str]) -> bool:
+        name = str(fname)
         if "suffix" in self.config:
-            if not str(fname).endswith(self.config["suffix"]):
+            if not name.endswith(self.config["suffix"]):
                 return False
         if "prefix" in self.config:
-            if not str(fname).startswith(self.config["prefix"]):
+            if not name.startswith(self.config["prefix"]):
                 return False
-        if "glob" in self.config:
-            if not fname.match(self.config["glob"]):
+        if "glob" in self.config or "iglob" in self.config:
+            path = pathlib.PurePath(fname)
+            if "glob" in self.config and not path.match(self.config["glob"]):
                 return False
-        if "iglob" in self.config:
-            if not fname.match(self.config["iglob"], case_sensitive=False):
+            if "iglob" in self.config and not path.match(self.config["iglob"], case_sensitive=False):
                 return False
         return True
 
-    def check(self, fname: pathlib.Path, stat: Optional[os.stat_result]) -> bool:
+    def count(self, **kwargs: int):
+        """add to counters. process_walk may call processor from multiple threads"""
+        with self.lock:
+            for k, v in kwargs.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def check(self, fname: Union[pathlib.Path, str], stat: Optional[Union[os.stat_result, S3Stat]]) -> bool:
+        """fname: local file, or S3 key (str) with S3Stat"""
         if stat is None:
-            stat = fname.stat()
+            stat = pathlib.Path(fname).stat()
         res = self.check_date_range(stat.st_mtime) and self.check_size_range(stat.st_size) and \
             self.check_name(fname)
         if res:
-            self.processed += 1
+            self.count(processed=1)
         else:
-            self.skipped += 1
+            self.count(skipped=1)
         return res
 
     @abstractmethod
@@ -90,7 +113,7 @@ class FileProcessor(ABC):
 
 
 class DebugProcessor(FileProcessor):
-    def check(self, fname: pathlib.Path, stat: Optional[os.stat_result]) -> bool:
+    def check(self, fname: Union[pathlib.Path, str], stat: Optional[Union[os.stat_result, S3Stat]]) -> bool:
         res = super().check(fname, stat)
         _log.debug("debug: fname=%s, stat=%s -> %s / %s", fname, stat, res, self.config)
         return res
@@ -128,13 +151,12 @@ class CompressProcessor(FileProcessor):
 
     def process(self, fname: pathlib.Path, stat: Optional[os.stat_result]) -> bool:
         compressor = self.config.get("compress", "gzip")
-        newname, data = auto_compress_stream(fname, compressor)
-        newpath = pathlib.Path(newname)
+        newpath = compressed_name(fname, compressor, stat.st_size if isinstance(stat, os.stat_result) else None)
         if newpath == fname:
             _log.debug("unchanged: fname=%s, stat=%s", fname, stat)
-            self.skipped += 1
-            self.processed -= 1
+            self.count(skipped=1, processed=-1)
             return False
+        _, data = auto_compress_stream(fname, compressor, threads=self.config.get("threads"))
         pfx = os.path.commonprefix([fname, newpath])
         if isinstance(stat, os.stat_result):
             before_sz = stat.st_size
@@ -142,8 +164,7 @@ class CompressProcessor(FileProcessor):
             before_sz = 0
         if self.config.get("dry", False):
             out_length = sum([len(x) for x in data.gen()])
-            self.before_total += before_sz
-            self.after_total += out_length
+            self.count(before_total=before_sz, after_total=out_length)
             _log.info("(dry) compress fname=%s{%s->%s}, size=%s->%s", pfx, str(fname)[len(pfx):],
                       str(newpath)[len(pfx):], before_sz, out_length)
         else:
@@ -152,8 +173,7 @@ class CompressProcessor(FileProcessor):
                 for _ in wrs.gen():
                     pass
             out_length = newpath.stat().st_size
-            self.before_total += before_sz
-            self.after_total += out_length
+            self.count(before_total=before_sz, after_total=out_length)
             _log.info("(wet) compress fname=%s{%s->%s}, size=%s->%s", pfx, str(fname)[len(pfx):],
                       str(newpath)[len(pfx):], before_sz, out_length)
             shutil.copystat(fname, newpath, follow_symlinks=False)
@@ -173,14 +193,15 @@ class S3Processor(FileProcessor):
 
     def process(self, fname: pathlib.Path, stat: Optional[os.stat_result]) -> bool:
         compressor = self.config.get("compress", "gzip")
-        newname, data = auto_compress_stream(fname, compressor)
-        newpath = pathlib.Path(newname)
+        newpath = compressed_name(fname, compressor, stat.st_size if isinstance(stat, os.stat_result) else None,
+                                  remote=True)
         base_name = newpath.relative_to(self.top)
         base_from = fname.relative_to(self.top)
         obj_name = self.prefix + str(base_name)
         if obj_name in self.skip_names:
             _log.debug("already exists: %s", obj_name)
             return True
+        _, data = auto_compress_stream(fname, compressor, remote=True)
         common_name = os.path.commonprefix([str(base_name), str(base_from)])
         rest1 = str(base_from)[len(common_name):]
         rest2 = str(base_name)[len(common_name):]
@@ -193,33 +214,84 @@ class S3Processor(FileProcessor):
             before_sz = 0
         if self.config.get("dry", False):
             out_length = sum([len(x) for x in data.gen()])
-            self.uploaded += out_length
+            self.count(uploaded=out_length)
             _log.info("(dry) upload {%s,%s}%s%s (%d->%d)",
                       self.top, self.prefix, common_name, reststr,
                       before_sz, out_length)
         else:
-            outstr = S3PutStream(data, self.s3, bucket=self.bucket, key=obj_name)
+            outstr = S3PutStream(data, self.s3, bucket=self.bucket, key=obj_name,
+                                 transfer_config=self.config.get("transfer_config"))
             for _ in outstr.gen():
                 pass
             res = self.s3.head_object(Bucket=self.bucket, Key=obj_name)
             out_length = res.get("ContentLength", 0)
-            self.uploaded += out_length
+            self.count(uploaded=out_length)
             _log.info("(wet) upload {%s,%s}%s%s (%d->%d)",
                       self.top, self.prefix, common_name, reststr,
                       before_sz, out_length)
         return False
 
 
-def process_walk(top: pathlib.Path, processors: Sequence[FileProcessor]):
-    for root, dirs, files in os.walk(top):
-        for f in files:
-            p = pathlib.Path(root, f)
-            st = p.stat(follow_symlinks=False)
-            for proc in processors:
-                chk = proc.check(p, st)
-                _log.debug("check %s(%s) -> %s", proc.__class__.__name__, p, chk)
-                if chk:
-                    res = proc.process(p, st)
-                    _log.debug("process %s(%s) -> %s", proc.__class__.__name__, p, chk)
-                    if res:
-                        break
+def walk_files(top: Union[str, os.PathLike]) -> Generator[os.DirEntry, None, None]:
+    """
+    non-directory entries under top, in the same order as os.walk
+
+    symlinks to directories are not followed, unreadable directories are skipped
+    """
+    try:
+        with os.scandir(top) as it:
+            # read whole directory first: processors may add/remove files in it
+            entries = list(it)
+    except OSError as e:
+        _log.debug("scandir %s: %s", top, e)
+        return
+    dirs = []
+    for ent in entries:
+        try:
+            is_dir = ent.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            yield ent
+        elif not ent.is_symlink():
+            dirs.append(ent.path)
+    for d in dirs:
+        yield from walk_files(d)
+
+
+def _process_file(p: pathlib.Path, st: os.stat_result, processors: Sequence[FileProcessor], debug: bool):
+    for proc in processors:
+        chk = proc.check(p, st)
+        if debug:
+            _log.debug("check %s(%s) -> %s", proc.__class__.__name__, p, chk)
+        if chk:
+            res = proc.process(p, st)
+            if debug:
+                _log.debug("process %s(%s) -> %s", proc.__class__.__name__, p, chk)
+            if res:
+                break
+
+
+def process_walk(top: pathlib.Path, processors: Sequence[FileProcessor], jobs: int = 1):
+    """
+    apply processors to each file under top
+
+    args:
+        jobs: number of files processed at the same time (threads)
+    """
+    # checked once: logging calls for every file and processor are not free
+    debug = _log.isEnabledFor(logging.DEBUG)
+    if jobs <= 1:
+        for ent in walk_files(top):
+            _process_file(pathlib.Path(ent.path), ent.stat(follow_symlinks=False), processors, debug)
+        return
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        pending: collections.deque = collections.deque()
+        for ent in walk_files(top):
+            pending.append(executor.submit(
+                _process_file, pathlib.Path(ent.path), ent.stat(follow_symlinks=False), processors, debug))
+            # do not walk too far ahead, raise error early
+            while len(pending) > jobs * 2:
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
@@ -1,4 +1,5 @@
 import unittest
+import sys
 import tempfile
 import datetime
 import gzip
@@ -76,6 +77,21 @@ class TestApp(unittest.TestCase):
             "2024-01-06", "2024-01-07", "2024-01-08", "2024-01-09", "2024-01-10"},
             set(res.json()["baz"].keys()))
 
+    def test_list_cache(self):
+        subdir = Path(self.td.name) / "foo" / "sub"
+        subdir.mkdir()
+        res = self.client.get("/list/foo")
+        self.assertEqual({"foo"}, set(res.json().keys()))
+        (subdir / "2024-03-01.log").write_text(self.raw_content)
+        res = self.client.get("/list/foo")
+        self.assertEqual({"foo"}, set(res.json().keys()))
+        update_config({"list_ttl": 0})
+        try:
+            res = self.client.get("/list/foo")
+            self.assertEqual({"foo", "foo/sub"}, set(res.json().keys()))
+        finally:
+            update_config({"list_ttl": 5})
+
     def test_read_raw(self):
         res = self.client.get("/read/baz/2024-01-01.log")
         self.assertEqual(200, res.status_code)
@@ -89,7 +105,8 @@ class TestApp(unittest.TestCase):
     def test_read_compressed(self):
         res = self.client.get("/read/baz/2024-02-11.log", headers={"accept-encoding": "gzip, br"})
         self.assertEqual(200, res.status_code)
-        self.assertEqual(self.gz_content, res.content)
+        self.assertEqual("gzip", res.headers.get("content-encoding"))
+        self.assertEqual(self.raw_content, res.text)
 
     def test_read_dir(self):
         res = self.client.get("/read/baz", headers={"accept-encoding": "gzip, br"})
@@ -180,3 +197,20 @@ class TestApp(unittest.TestCase):
             res = self.client.get("/list/test")
             self.assertEqual(200, res.status_code)
             self.assertNotIn("testlink", res.json())
+
+    def test_list_cache_threads(self):
+        from unittest.mock import patch
+        from concurrent.futures import ThreadPoolExecutor
+        from log2s3 import app
+        prefixes = ["hello", "world", "foo", "bar", "baz", "2024-01", "2024-02"]
+        interval = sys.getswitchinterval()
+        # switch threads often, to interleave evictions
+        sys.setswitchinterval(1e-6)
+        try:
+            with patch.object(app, "_ldir_cache_size", 2), ThreadPoolExecutor(8) as executor:
+                # cache is always full: every call evicts
+                results = list(executor.map(lambda i: app.list_dir(prefixes[i % len(prefixes)]), range(1000)))
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(1000, len(results))
+        self.assertLessEqual(len(app._ldir_cache), 2)
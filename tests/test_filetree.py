@@ -56,6 +56,20 @@ class TestProcessor(unittest.TestCase):
         self.assertEqual(0, res.exit_code)
         self.assertEqual(5, len(glob.glob(os.path.join(self.td.name, "*", "*.gz"))))
 
+    def test_compress_jobs(self):
+        from unittest.mock import patch
+        from log2s3 import processor
+        with patch("os.cpu_count", return_value=8), \
+                patch.object(processor, "auto_compress_stream", wraps=processor.auto_compress_stream) as acs:
+            res = CliRunner().invoke(cli, ["filetree-compress", "--top", self.td.name, "--jobs", "4", "--compress",
+                                           "xz", "--date", (datetime.now()-timedelta(days=2)).strftime("%Y-%m-%d")])
+            if res.exception:
+                raise res.exception
+        self.assertEqual(0, res.exit_code)
+        self.assertEqual(5, len(glob.glob(os.path.join(self.td.name, "*", "*.xz"))))
+        # 8 cpus shared by 4 jobs
+        self.assertEqual({2}, {x.kwargs["threads"] for x in acs.call_args_list})
+
     def test_delete(self):
         res = CliRunner().invoke(cli, ["filetree-delete", "--top", self.td.name, "--date",
                                        (datetime.now()-timedelta(days=2)).strftime("%Y-%m-%d")])
@@ -119,3 +133,63 @@ class TestMerge(unittest.TestCase):
         if res.exception:
             raise res.exception
         self.assertIn("hello world", res.output)
+
+    def test_threads_option(self):
+        from log2s3 import compr_stream
+        res = CliRunner().invoke(cli, ["--threads", "2", "filetree-list", "--top", self.td.name])
+        if res.exception:
+            raise res.exception
+        self.assertEqual(2, compr_stream.compress_threads)
+        # not kept for next invocation
+        res = CliRunner().invoke(cli, ["filetree-list", "--top", self.td.name])
+        if res.exception:
+            raise res.exception
+        self.assertIsNone(compr_stream.compress_threads)
+        for v in ["0", "-3"]:
+            res = CliRunner().invoke(cli, ["--threads", v, "filetree-list", "--top", self.td.name])
+            self.assertEqual(2, res.exit_code)
+
+    def test_zstd_dict_unavailable(self):
+        from unittest.mock import patch
+        from log2s3 import compr_stream
+        dictfile = self.basedir / "log.dict"
+        dictfile.write_bytes(b"dummy")
+        with patch.dict(compr_stream.__dict__):
+            # as installed with zstd package only
+            compr_stream.__dict__.pop("set_zstd_dict", None)
+            compr_stream.__dict__.pop("train_zstd_dict", None)
+            res = CliRunner().invoke(cli, ["zstd-train", "--output", str(dictfile), self.td.name])
+            self.assertEqual(2, res.exit_code)
+            self.assertIn("requires the zstandard package", res.output)
+            res = CliRunner().invoke(cli, ["--zstd-dict", str(dictfile), "filetree-list", "--top", self.td.name])
+            self.assertEqual(2, res.exit_code)
+            self.assertIn("requires the zstandard package", res.output)
+
+    def test_zstd_train(self):
+        from log2s3 import compr_stream
+        if not hasattr(compr_stream, "set_zstd_dict"):
+            self.skipTest("zstandard not installed")
+        dictfile = self.basedir / "log.dict"
+        res = CliRunner().invoke(cli, ["zstd-train", "--output", str(dictfile), "--size", "4096", self.td.name])
+        if res.exception:
+            raise res.exception
+        self.assertTrue(dictfile.exists())
+        dt = datetime.now() - timedelta(days=1)
+        fn1 = self.basedir / "dir0" / dt.strftime("%Y-%m-%d.log")
+        try:
+            res = CliRunner().invoke(cli, ["--zstd-dict", str(dictfile), "filetree-compress",
+                                           "--top", str(self.basedir / "dir0"), "--compress", "zstd"])
+            if res.exception:
+                raise res.exception
+            self.assertFalse(fn1.exists())
+            res = CliRunner().invoke(cli, ["--zstd-dict", str(dictfile), "cat", str(fn1) + ".zstd"])
+            if res.exception:
+                raise res.exception
+            self.assertIn("dir0 hello world", res.output)
+            # not kept for next invocation
+            res = CliRunner().invoke(cli, ["filetree-list", "--top", self.td.name])
+            if res.exception:
+                raise res.exception
+            self.assertIsNone(compr_stream.zstd_dict)
+        finally:
+            compr_stream.set_zstd_dict(None)
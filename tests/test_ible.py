@@ -4,6 +4,7 @@ import tempfile
 import json
 from click.testing import CliRunner
 from log2s3.main import cli
+from log2s3.compr_stream import s3_transfer_options
 
 
 class TestIble(unittest.TestCase):
@@ -175,12 +176,13 @@ log2s3 filetree-delete --older 400d --top /var/log/container
             fc.assert_called_once()
             self.assertEqual(
                 {"older": "1d", "newer": "7d", "bigger": "10k", "top": "/var/log/container",
-                 "compress": "xz"},
+                 "compress": "xz", "jobs": 1},
                 {k: v for k, v in fc.call_args.kwargs.items() if bool(v)})
             spt.assert_called_once()
             self.assertEqual(
                 {"older": "2d", "newer": "7d", "top": "/var/log/container",
-                 "compress": "xz", "dotenv": True, "s3_secret_key": "mysecretkey"},
+                 "compress": "xz", "dotenv": True, "s3_secret_key": "mysecretkey",
+                 "s3_concurrency": s3_transfer_options["max_concurrency"]},
                 {k: v for k, v in spt.call_args.kwargs.items() if bool(v)})
             fd.assert_called_once()
             self.assertEqual(
@@ -3,7 +3,7 @@ from datetime import datetime, timedelta
 import tempfile
 import pathlib
 import os
-from log2s3.processor import process_walk, DelProcessor, CompressProcessor
+from log2s3.processor import process_walk, walk_files, DelProcessor, CompressProcessor
 
 
 class TestProcessor(unittest.TestCase):
@@ -85,3 +85,21 @@ class TestProcessor(unittest.TestCase):
         process_walk(self.basedir, [dp])
         cnts = self._count()
         self.assertEqual(pre_cnts, cnts)  # do nothing
+
+    def test_walk_files(self):
+        (self.basedir / "link0").symlink_to(self.basedir / "dir0", target_is_directory=True)
+        (self.basedir / "file0").write_bytes(b"")
+        expected = sorted(str(pathlib.Path(root, x)) for root, _, files in os.walk(self.basedir) for x in files)
+        self.assertEqual(expected, sorted(x.path for x in walk_files(self.basedir)))
+        self.assertEqual([], list(walk_files(self.basedir / "not-exists")))
+
+    def test_compress_jobs(self):
+        pre_cnts = self._count()
+        dp = CompressProcessor({"older": "2d", "bigger": "1k", "compress": "gzip"})
+        process_walk(self.basedir, [dp], jobs=4)
+        cnts = self._count()
+        self.assertEqual(pre_cnts[0], cnts[0])
+        self.assertGreater(pre_cnts[1], cnts[1])
+        self.assertEqual(5 * 8, dp.processed)
+        self.assertEqual(5 * 2, dp.skipped)
+        self.assertEqual(dp.after_total, cnts[1] - (pre_cnts[1] - dp.before_total))
@@ -1,15 +1,16 @@
 import unittest
 import datetime
+import tempfile
 from click.testing import CliRunner
 from unittest.mock import patch, MagicMock, ANY
-from log2s3.main import cli
+from log2s3.main import cli, _s3_client
 
 now = datetime.datetime.now()
 
 
 class TestS3(unittest.TestCase):
     def setUp(self):
-        pass
+        _s3_client.cache_clear()
 
     def tearDown(self):
         pass
@@ -29,8 +30,42 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.assert_called_once_with(
                 's3', aws_access_key_id="access123", aws_secret_access_key="secret123",
-                region_name="region123", endpoint_url="https://example.com/")
+                region_name="region123", endpoint_url="https://example.com/", config=ANY)
             cl.return_value.create_bucket.assert_called_once_with(Bucket="mytestbucket123")
+            config = cl.call_args.kwargs["config"]
+            self.assertGreaterEqual(config.max_pool_connections, 32)
+            self.assertEqual("adaptive", config.retries["mode"])
+
+    def test_s3_client_shared(self):
+        with patch("boto3.client") as cl:
+            for _ in range(2):
+                res = CliRunner().invoke(cli, ["s3-bucket"], env=self.envs)
+                if res.exception:
+                    raise res.exception
+            cl.assert_called_once()
+            self.assertEqual(2, cl.return_value.list_buckets.call_count)
+
+    def test_s3_concurrency(self):
+        from log2s3.compr_stream import s3_transfer_options
+        default = s3_transfer_options["max_concurrency"]
+        with tempfile.NamedTemporaryFile() as tf, patch("boto3.client") as cl:
+            tf.write(b"hello world\n" * 100)
+            tf.flush()
+            for args, envs, concurrency in [
+                    (["--s3-concurrency", "64"], self.envs, 64),
+                    ([], self.envs | {"LOG2S3_S3_CONCURRENCY": "48"}, 48),
+                    ([], self.envs, default)]:
+                res = CliRunner().invoke(cli, ["s3-put1", "--s3-bucket", "bucket123", "--key", "key123",
+                                               *args, tf.name], env=envs)
+                if res.exception:
+                    raise res.exception
+                self.assertEqual(concurrency, cl.return_value.upload_fileobj.call_args.kwargs["Config"].max_concurrency)
+                self.assertGreaterEqual(cl.call_args.kwargs["config"].max_pool_connections, concurrency)
+            # not stored in module state
+            self.assertEqual(default, s3_transfer_options["max_concurrency"])
+            res = CliRunner().invoke(cli, ["s3-put1", "--s3-bucket", "bucket123", "--key", "key123",
+                                           "--s3-concurrency", "0", tf.name], env=self.envs)
+            self.assertEqual(2, res.exit_code)
 
     def test_s3_list_buckets(self):
         with patch("boto3.client") as cl:
@@ -40,13 +75,14 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.assert_called_once_with(
                 's3', aws_access_key_id="access123", aws_secret_access_key="secret123",
-                region_name="region123", endpoint_url="https://example.com/")
+                region_name="region123", endpoint_url="https://example.com/", config=ANY)
             cl.return_value.list_buckets.assert_called_once_with()
 
     def test_s3_list_objects(self):
         with patch("boto3.client") as cl:
-            cl.return_value.list_objects.side_effect = [{
+            cl.return_value.list_objects_v2.side_effect = [{
                 "IsTruncated": True,
+                "NextContinuationToken": "token123",
                 "Contents": [{"LastModified": now, "Size": 1234, "Key": "key1234"}],
             }, {
                 "IsTruncated": False,
@@ -59,14 +95,29 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.assert_called_once_with(
                 's3', aws_access_key_id="access123", aws_secret_access_key="secret123",
-                region_name="region123", endpoint_url="https://example.com/")
-            self.assertEqual(2, cl.return_value.list_objects.call_count)
+                region_name="region123", endpoint_url="https://example.com/", config=ANY)
+            self.assertEqual(2, cl.return_value.list_objects_v2.call_count)
             self.assertIn("key12345", res.output)
 
+    def test_s3_list_glob(self):
+        with patch("boto3.client") as cl:
+            cl.return_value.list_objects_v2.return_value = {
+                "IsTruncated": False,
+                "Contents": [{"LastModified": now, "Size": 1234, "Key": "dir1/key1234.log"},
+                             {"LastModified": now, "Size": 12345, "Key": "dir1/key12345.gz"}],
+            }
+            res = CliRunner().invoke(cli, ["s3-list", "--s3-bucket", "bucket123", "--glob", "*.log"], env=self.envs)
+            if res.exception:
+                raise res.exception
+            self.assertEqual(0, res.exit_code)
+            self.assertIn("key1234.log", res.output)
+            self.assertNotIn("key12345.gz", res.output)
+
     def test_s3_du(self):
         with patch("boto3.client") as cl:
-            cl.return_value.list_objects.side_effect = [{
+            cl.return_value.list_objects_v2.side_effect = [{
                 "IsTruncated": True,
+                "NextContinuationToken": "token123",
                 "Contents": [
                     {"LastModified": now, "Size": 1234, "Key": "dir1/key1234"},
                     {"LastModified": now, "Size": 4321, "Key": "dir1/key2345"},
@@ -85,14 +136,14 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.assert_called_once_with(
                 's3', aws_access_key_id="access123", aws_secret_access_key="secret123",
-                region_name="region123", endpoint_url="https://example.com/")
-            self.assertEqual(2, cl.return_value.list_objects.call_count)
+                region_name="region123", endpoint_url="https://example.com/", config=ANY)
+            self.assertEqual(2, cl.return_value.list_objects_v2.call_count)
             self.assertIn(" 9999 ", res.output)  # 1234 + 4321 + 4444
             self.assertIn(" 3 dir1", res.output)
 
     def test_s3_du_empty(self):
         with patch("boto3.client") as cl:
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": [],
             }
@@ -102,13 +153,14 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.assert_called_once_with(
                 's3', aws_access_key_id="access123", aws_secret_access_key="secret123",
-                region_name="region123", endpoint_url="https://example.com/")
+                region_name="region123", endpoint_url="https://example.com/", config=ANY)
             self.assertIn("empty result", res.output)
 
     def test_s3_du_s(self):
         with patch("boto3.client") as cl:
-            cl.return_value.list_objects.side_effect = [{
+            cl.return_value.list_objects_v2.side_effect = [{
                 "IsTruncated": True,
+                "NextContinuationToken": "token123",
                 "Contents": [
                     {"LastModified": now, "Size": 1234, "Key": "dir1/key1234"},
                     {"LastModified": now, "Size": 4321, "Key": "dir1/key/2345"},
@@ -127,8 +179,8 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.assert_called_once_with(
                 's3', aws_access_key_id="access123", aws_secret_access_key="secret123",
-                region_name="region123", endpoint_url="https://example.com/")
-            self.assertEqual(2, cl.return_value.list_objects.call_count)
+                region_name="region123", endpoint_url="https://example.com/", config=ANY)
+            self.assertEqual(2, cl.return_value.list_objects_v2.call_count)
             self.assertIn(" 9999 ", res.output)  # 1234 + 4321 + 4444
             self.assertIn(" 3 dir1", res.output)
             self.assertIn(" 1 dir1/key", res.output)
@@ -139,7 +191,7 @@ class TestS3(unittest.TestCase):
             now = datetime.now()
             c = [{"LastModified": now-timedelta(x), "Size": x*1000, "Key": f"obj{x}"}
                  for x in range(10)]
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": c,
             }
@@ -149,7 +201,22 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.return_value.delete_objects.assert_called_once_with(
                 Bucket="bucket123",
-                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(10)]})
+                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(10)], "Quiet": True})
+
+    def test_s3_del_by_batch(self):
+        with patch("boto3.client") as cl:
+            c = [{"LastModified": now, "Size": 1000, "Key": f"obj{x}"} for x in range(2500)]
+            cl.return_value.list_objects_v2.return_value = {
+                "IsTruncated": False,
+                "Contents": c,
+            }
+            res = CliRunner().invoke(cli, ["s3-delete-by", "--s3-bucket", "bucket123", "--wet"], env=self.envs)
+            if res.exception:
+                raise res.exception
+            self.assertEqual(0, res.exit_code)
+            self.assertEqual(3, cl.return_value.delete_objects.call_count)
+            last = cl.return_value.delete_objects.call_args.kwargs["Delete"]["Objects"]
+            self.assertEqual([{"Key": f"obj{x}"} for x in range(2000, 2500)], last)
 
     def test_s3_del_by_older(self):
         with patch("boto3.client") as cl:
@@ -157,7 +224,7 @@ class TestS3(unittest.TestCase):
             now = datetime.now()
             c = [{"LastModified": now-timedelta(x), "Size": x*1000, "Key": f"obj{x}"}
                  for x in range(10)]
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": c,
             }
@@ -167,7 +234,7 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.return_value.delete_objects.assert_called_once_with(
                 Bucket="bucket123",
-                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(3, 10)]})
+                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(3, 10)], "Quiet": True})
 
     def test_s3_del_by_older_dry(self):
         with patch("boto3.client") as cl:
@@ -175,7 +242,7 @@ class TestS3(unittest.TestCase):
             now = datetime.now()
             c = [{"LastModified": now-timedelta(x), "Size": x*1000, "Key": f"obj{x}"}
                  for x in range(10)]
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": c,
             }
@@ -193,7 +260,7 @@ class TestS3(unittest.TestCase):
             now = datetime.now()
             c = [{"LastModified": now-timedelta(x), "Size": x*1000, "Key": f"obj{x}"}
                  for x in range(10)]
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": c,
             }
@@ -203,7 +270,7 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.return_value.delete_objects.assert_called_once_with(
                 Bucket="bucket123",
-                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(3)]})
+                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(3)], "Quiet": True})
 
     def test_s3_del_by_older_newer(self):
         with patch("boto3.client") as cl:
@@ -211,7 +278,7 @@ class TestS3(unittest.TestCase):
             now = datetime.now()
             c = [{"LastModified": now-timedelta(x), "Size": x*1000, "Key": f"obj{x}"}
                  for x in range(10)]
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": c,
             }
@@ -222,7 +289,7 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.return_value.delete_objects.assert_called_once_with(
                 Bucket="bucket123",
-                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(2, 7)]})
+                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(2, 7)], "Quiet": True})
 
     def test_s3_del_by_bigger(self):
         with patch("boto3.client") as cl:
@@ -230,7 +297,7 @@ class TestS3(unittest.TestCase):
             now = datetime.now()
             c = [{"LastModified": now-timedelta(x), "Size": x*1000, "Key": f"obj{x}"}
                  for x in range(10)]
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": c,
             }
@@ -241,7 +308,7 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.return_value.delete_objects.assert_called_once_with(
                 Bucket="bucket123",
-                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(5, 10)]})
+                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(5, 10)], "Quiet": True})
 
     def test_s3_del_by_smaller(self):
         with patch("boto3.client") as cl:
@@ -249,7 +316,7 @@ class TestS3(unittest.TestCase):
             now = datetime.now()
             c = [{"LastModified": now-timedelta(x), "Size": x*1000, "Key": f"obj{x}"}
                  for x in range(10)]
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": c,
             }
@@ -260,7 +327,7 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.return_value.delete_objects.assert_called_once_with(
                 Bucket="bucket123",
-                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(5)]})
+                Delete={"Objects": [{"Key": f"obj{x}"} for x in range(5)], "Quiet": True})
 
     def test_s3_del_by_suffix(self):
         with patch("boto3.client") as cl:
@@ -268,7 +335,7 @@ class TestS3(unittest.TestCase):
             now = datetime.now()
             c = [{"LastModified": now-timedelta(x), "Size": x*1000, "Key": f"obj{x}"}
                  for x in range(11)]
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": c,
             }
@@ -279,7 +346,7 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.return_value.delete_objects.assert_called_once_with(
                 Bucket="bucket123",
-                Delete={"Objects": [{"Key": "obj0"}, {"Key": "obj10"}]})
+                Delete={"Objects": [{"Key": "obj0"}, {"Key": "obj10"}], "Quiet": True})
 
     def test_s3_del_by_notfound(self):
         with patch("boto3.client") as cl:
@@ -287,7 +354,7 @@ class TestS3(unittest.TestCase):
             now = datetime.now()
             c = [{"LastModified": now-timedelta(x), "Size": x*1000, "Key": f"obj{x}"}
                  for x in range(11)]
-            cl.return_value.list_objects.return_value = {
+            cl.return_value.list_objects_v2.return_value = {
                 "IsTruncated": False,
                 "Contents": c,
             }
@@ -317,6 +384,22 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             self.assertEqual(bindata.decode("utf-8"), res.output)
 
+    def test_s3_cat_many(self):
+        import gzip
+
+        def get_object(Bucket, Key, **kwargs):
+            read_mock = MagicMock()
+            read_mock.iter_chunks.return_value = [gzip.compress(Key.encode("utf-8") + b"\n")]
+            return {"Body": read_mock}
+        keys = [f"path/to/{x}.gz" for x in range(20)]
+        with patch("boto3.client") as cl:
+            cl.return_value.get_object.side_effect = get_object
+            res = CliRunner().invoke(cli, ["s3-cat", "--s3-bucket", "bucket123", *keys], env=self.envs)
+            if res.exception:
+                raise res.exception
+            self.assertEqual(0, res.exit_code)
+            self.assertEqual("".join(x + "\n" for x in keys), res.output)
+
     def test_s3_less_bz2(self):
         bindata = b'hello world\n' * 1024
         import bz2
@@ -401,3 +484,75 @@ class TestS3(unittest.TestCase):
             self.assertEqual(0, res.exit_code)
             cl.return_value.put_object.assert_not_called()
             self.assertIn("(dry) changed", "\n".join(alog.output))
+
+    def test_s3_compress_tree_unchanged(self):
+        with patch("boto3.client") as cl:
+            cl.return_value.list_objects_v2.return_value = {
+                "IsTruncated": False,
+                "Contents": [{"LastModified": now, "Size": 1234, "Key": "path/to/hello.gz"}],
+            }
+            res = CliRunner().invoke(cli, ["s3-compress-tree", "--s3-bucket", "bucket123", "--compress", "gzip",
+                                           "--wet", "--remove"], env=self.envs)
+            if res.exception:
+                raise res.exception
+            self.assertEqual(0, res.exit_code)
+            cl.return_value.get_object.assert_not_called()
+            cl.return_value.delete_object.assert_not_called()
+
+    def test_s3_compress_tree_jobs(self):
+        def get_object(Bucket, Key):
+            read_mock = MagicMock()
+            read_mock.iter_chunks.return_value = [Key.encode("utf-8")]
+            return {"Body": read_mock}
+        from log2s3 import main
+        keys = [f"path/to/file{i}.log" for i in range(5)]
+        with patch("boto3.client") as cl, patch("os.cpu_count", return_value=8), \
+                patch.object(main, "auto_compress_stream", wraps=main.auto_compress_stream) as acs:
+            cl.return_value.list_objects_v2.return_value = {
+                "IsTruncated": False,
+                "Contents": [{"LastModified": now, "Size": 5, "Key": k} for k in keys],
+            }
+            cl.return_value.get_object.side_effect = get_object
+            cl.return_value.head_object.return_value = {"ContentLength": 25}
+            res = CliRunner().invoke(cli, ["s3-compress-tree", "--s3-bucket", "bucket123", "--compress", "gzip",
+                                           "--wet", "--remove", "--jobs", "4", "--s3-concurrency", "16"],
+                                     env=self.envs)
+            if res.exception:
+                raise res.exception
+            self.assertEqual(0, res.exit_code)
+            put_keys = sorted(x.args[2] for x in cl.return_value.upload_fileobj.call_args_list)
+            self.assertEqual([k + ".gz" for k in keys], put_keys)
+            # cpus and part uploads are shared by 4 jobs
+            self.assertEqual({2}, {x.kwargs["threads"] for x in acs.call_args_list})
+            self.assertEqual({4}, {x.kwargs["Config"].max_concurrency
+                                   for x in cl.return_value.upload_fileobj.call_args_list})
+            self.assertGreaterEqual(cl.call_args.kwargs["config"].max_pool_connections, 4 * 4)
+            deleted = sorted(x.kwargs["Key"] for x in cl.return_value.delete_object.call_args_list)
+            self.assertEqual(keys, deleted)
+
+    def test_s3_del_keys(self):
+        keys = [f"path/to/{x}.gz" for x in range(20)]
+        with patch("boto3.client") as cl:
+            cl.return_value.head_object.side_effect = lambda Bucket, Key: {
+                "LastModified": now, "ContentLength": len(Key)}
+            res = CliRunner().invoke(cli, ["s3-del", "--s3-bucket", "bucket123", "--wet", *keys], env=self.envs)
+            if res.exception:
+                raise res.exception
+            self.assertEqual(0, res.exit_code)
+            self.assertEqual(keys, [x.split()[-1] for x in res.output.splitlines()])
+            cl.return_value.delete_objects.assert_called_once_with(Bucket="bucket123", Delete={
+                "Objects": [{"Key": k} for k in keys], "Quiet": True})
+
+    def test_existing_keys(self):
+        from botocore.exceptions import ClientError
+        from log2s3.main import ExistingKeys
+        s3 = MagicMock()
+
+        def head_object(Bucket, Key):
+            if Key != "exists":
+                raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+            return {}
+        s3.head_object.side_effect = head_object
+        keys = ExistingKeys(s3, "bucket123")
+        self.assertIn("exists", keys)
+        self.assertNotIn("notfound", keys)
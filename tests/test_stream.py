@@ -5,8 +5,9 @@ import lzma
 import gzip
 import pathlib
 from log2s3.compr_stream import FileReadStream, FileWriteStream, \
-    RawReadStream, stream_map, auto_compress_stream, \
-    S3PutStream
+    RawReadStream, stream_map, auto_compress_stream, compressed_name, \
+    S3PutStream, split_stream_ext, MmapReadStream, SimpleFilterStream, GzipCompressorStream
+from log2s3.common_stream import Stream, MergeStream, PrefetchStream
 
 
 class TestInOut(unittest.TestCase):
@@ -32,6 +33,14 @@ class TestInOut(unittest.TestCase):
                 decomp = decompr(comp)
                 self.assertEqual(self.text_output, list(decomp.text_gen()))
 
+    def test_text_gen_newlines(self):
+        import io
+        data = "hello\r\nworld\rこんにちは\n\r\nrest".encode("utf-8")
+        expected = list(io.TextIOWrapper(io.BytesIO(data), encoding="utf-8"))
+        for bufsize in (1, 2, 7, 1000):
+            with self.subTest(bufsize=bufsize):
+                self.assertEqual(expected, list(RawReadStream(data, bufsize).text_gen()))
+
     def test_write(self):
         for k, v in stream_map.items():
             ext, compr, decompr = v
@@ -48,6 +57,41 @@ class TestInOut(unittest.TestCase):
                     tfout.seek(0)
                     self.assertEqual(self.input_data, tfout.read())
 
+    def test_incremental(self):
+        class NoReadAllStream(RawReadStream):
+            def read_all(self):
+                raise AssertionError("read_all called")
+
+        streaming = {"gzip", "bzip2", "xz", "lzma", "zstd", "lz4", "brotli", "zlib-ng"}
+        for k, v in stream_map.items():
+            if k not in streaming or issubclass(v[1], SimpleFilterStream):
+                # python-zstd fallback is whole-buffer
+                continue
+            ext, compr, decompr = v
+            with self.subTest(f"incremental {k}"):
+                cdata = b"".join(compr(NoReadAllStream(self.input_data, 100)).gen())
+                ddata = b"".join(decompr(NoReadAllStream(cdata, 100)).gen())
+                self.assertEqual(self.input_data, ddata)
+
+    def test_brotli_finish(self):
+        if "brotli" not in stream_map:
+            self.skipTest("brotli not installed")
+        import brotli
+        data = bytes(range(256)) * 10000
+        for chunks in (RawReadStream(data, 100000), RawReadStream(memoryview(data), 100000)):
+            cdata = stream_map["brotli"][1](chunks).read_all()
+            self.assertEqual(data, brotli.decompress(cdata))
+
+    def test_write_raw(self):
+        self.tf.seek(6)
+        with tempfile.TemporaryFile("w+b") as tfout:
+            tfout.write(b"head:")
+            wr = FileWriteStream(FileReadStream(self.tf, 1000), tfout)
+            self.assertEqual(len(self.input_data) - 6, sum(wr.gen()))
+            tfout.write(b":tail")
+            tfout.seek(0)
+            self.assertEqual(b"head:" + self.input_data[6:] + b":tail", tfout.read())
+
 
 class TestAutoStream(unittest.TestCase):
     def test_xz2decompress(self):
@@ -103,6 +147,193 @@ class TestAutoStream(unittest.TestCase):
             self.assertEqual(xzdata, cst.read_all())
             self.assertEqual(tf.name+".xz", str(name))
 
+    def test_gzip_multi_member(self):
+        data1 = b"hello world\n" * 1000
+        data2 = b"good bye\n" * 1000
+        st = RawReadStream(gzip.compress(data1) + gzip.compress(data2), 100)
+        name, cst = auto_compress_stream(pathlib.Path("hello.gz"), "decompress", st)
+        self.assertEqual(data1 + data2, cst.read_all())
+        self.assertEqual("hello", str(name))
+
+    def test_pooled_compressor(self):
+        data1 = b"hello world\n" * 1000
+        data2 = b"good bye\n" * 1000
+        for mode in {"zstd", "lz4"} & set(stream_map.keys()):
+            with self.subTest(mode=mode):
+                _, cst, dst = stream_map[mode]
+                # sequential (reused context) and interleaved (two contexts)
+                c1 = cst(RawReadStream(data1)).read_all()
+                c2 = cst(RawReadStream(data2)).read_all()
+                g1, g2 = cst(RawReadStream(data1, 100)).gen(), cst(RawReadStream(data2, 100)).gen()
+                p2, p1 = zip(*zip(g2, g1))
+                self.assertEqual(data1, dst(RawReadStream(c1)).read_all())
+                self.assertEqual(data2, dst(RawReadStream(c2)).read_all())
+                self.assertEqual(data2, dst(RawReadStream(b"".join(p2))).read_all())
+                self.assertEqual(data1, dst(RawReadStream(b"".join(p1) + b"".join(g1))).read_all())
+
+    def test_mmap(self):
+        data = b"hello world\n" * 1000
+        with tempfile.TemporaryDirectory() as td:
+            fn = pathlib.Path(td) / "hello.log"
+            fn.write_bytes(data)
+            self.assertEqual(data, MmapReadStream(fn.open("rb"), 100).read_all())
+            for mode, (_, _, decompr) in stream_map.items():
+                with self.subTest(mode=mode):
+                    _, cst = auto_compress_stream(fn, mode)
+                    self.assertEqual(data, decompr(RawReadStream(cst.read_all())).read_all())
+            # empty file
+            fn.write_bytes(b"")
+            _, cst = auto_compress_stream(fn, "gzip")
+            self.assertEqual(b"", gzip.decompress(cst.read_all()))
+
+    def test_mmap_modes_memoryview(self):
+        from log2s3.compr_stream import mmap_modes
+        data = b"hello world\n" * 1000
+        for mode in mmap_modes:
+            _, cst, dst = stream_map[mode]
+            with self.subTest(mode=mode):
+                compressed = cst(RawReadStream(memoryview(data))).read_all()
+                self.assertEqual(data, dst(RawReadStream(memoryview(compressed))).read_all())
+
+    def test_zstd_content_size(self):
+        try:
+            import zstandard
+        except ImportError:
+            self.skipTest("zstandard not installed")
+        data = b"hello world\n" * 1000
+        _, cst, dst = stream_map["zstd"]
+        compressed = cst(RawReadStream(data)).read_all()
+        self.assertEqual(len(data), zstandard.get_frame_parameters(compressed).content_size)
+        self.assertEqual(data, dst(RawReadStream(compressed)).read_all())
+
+    def test_xz_parallel(self):
+        from unittest.mock import patch
+        from log2s3 import compr_stream
+        data = bytes(range(256)) * 1000
+        with patch.object(compr_stream, "xz_block_size", 10000):
+            cdata = compr_stream.XzCompressorStream(RawReadStream(data, 3000), threads=2).read_all()
+            empty = compr_stream.XzCompressorStream(RawReadStream(b""), threads=2).read_all()
+        self.assertEqual(data, lzma.decompress(cdata))
+        self.assertEqual(data, compr_stream.XzDecompressorStream(RawReadStream(cdata, 1000)).read_all())
+        self.assertEqual(b"", compr_stream.XzDecompressorStream(RawReadStream(empty)).read_all())
+
+    def test_xz_threads(self):
+        from unittest.mock import patch
+        from log2s3 import compr_stream
+        with patch("os.cpu_count", return_value=64):
+            self.assertEqual(compr_stream.xz_max_threads, compr_stream.XzCompressorStream(RawReadStream(b"")).threads)
+            with patch.object(compr_stream, "compress_threads", 16):
+                self.assertEqual(16, compr_stream.XzCompressorStream(RawReadStream(b"")).threads)
+        # encoder is created only for single thread
+        st = compr_stream.XzCompressorStream(RawReadStream(b"hello"), threads=2)
+        self.assertIsNone(st.compr)
+        self.assertEqual(b"hello", lzma.decompress(st.read_all()))
+        self.assertIsNone(st.compr)
+        st = compr_stream.XzCompressorStream(RawReadStream(b"hello"), threads=1)
+        self.assertEqual(b"hello", lzma.decompress(st.read_all()))
+        self.assertIsNotNone(st.compr)
+
+    def test_gzip_bz2_parallel(self):
+        from unittest.mock import patch
+        from log2s3 import compr_stream
+        import bz2
+        data = bytes(range(256)) * 1000
+        for cls, decompress in ((compr_stream.GzipCompressorStream, gzip.decompress),
+                                (compr_stream.Bz2CompressorStream, bz2.decompress)):
+            with self.subTest(cls.__name__), patch.object(compr_stream, "parallel_block_size", 10000):
+                st = cls(RawReadStream(data, 3000), threads=2)
+                cdata = st.read_all()
+                # single thread compressor is not created
+                self.assertIsNone(st.compr)
+                empty = cls(RawReadStream(b""), threads=2).read_all()
+                self.assertEqual(data, decompress(cdata))
+                self.assertEqual(data, decompress(cls(Stream(RawReadStream(data, 3000)), threads=1).read_all()))
+                self.assertEqual(b"", decompress(empty))
+
+    def test_bz2_multi_stream(self):
+        import bz2
+        data1 = b"hello world\n" * 1000
+        data2 = b"good bye\n" * 1000
+        st = RawReadStream(bz2.compress(data1) + bz2.compress(data2), 100)
+        _, cst = auto_compress_stream(pathlib.Path("hello.bz2"), "decompress", st)
+        self.assertEqual(data1 + data2, cst.read_all())
+
+    def test_block_aligned_read(self):
+        from unittest.mock import MagicMock
+        from log2s3 import compr_stream
+        from log2s3.compr_stream import Bz2CompressorStream
+        data = b"hello world\n" * 1000
+        with tempfile.TemporaryFile("r+b") as tf:
+            tf.write(data)
+            tf.seek(0)
+            rd = FileReadStream(tf)
+            cst = Bz2CompressorStream(rd, threads=1)
+            self.assertEqual(0, rd.bufsize % 900000)
+            self.assertLessEqual(rd.bufsize, 10*1024*1024)
+            import bz2
+            self.assertEqual(data, bz2.decompress(cst.read_all()))
+            # parallel: aligned to block of each thread
+            tf.seek(0)
+            rd = FileReadStream(tf)
+            cst = Bz2CompressorStream(rd, threads=2)
+            self.assertEqual(data, bz2.decompress(cst.read_all()))
+            self.assertEqual(compr_stream.parallel_block_size, rd.bufsize)
+        # S3 input is wrapped by PrefetchStream
+        s3 = MagicMock()
+        s3.get_object.return_value = {"ContentLength": len(data), "Body": MagicMock()}
+        s3.get_object.return_value["Body"].iter_chunks.return_value = [data]
+        rd = compr_stream.s3_get_stream(s3, "bucket123", "hello.log")
+        _, cst = auto_compress_stream(pathlib.Path("hello.log"), "bzip2", rd)
+        self.assertIsInstance(cst.prev, PrefetchStream)
+        self.assertEqual(0, rd.bufsize % 900000)
+
+    def test_gzip_oneshot(self):
+        try:
+            import deflate
+        except ImportError:
+            self.skipTest("deflate not installed")
+        from unittest.mock import patch
+        from log2s3 import compr_stream
+        data = b"hello world\n" * 1000
+        with patch.object(compr_stream, "_gzip_oneshot", deflate.gzip_compress):
+            cdata = compr_stream.GzipCompressorStream(RawReadStream(data)).read_all()
+        self.assertEqual(data, gzip.decompress(cdata))
+
+    def test_split_ext(self):
+        self.assertEqual(("dir/hello.log", "gzip"), (split_stream_ext("dir/hello.log.gz")[0],
+                                                     split_stream_ext("dir/hello.log.gz")[1][0]))
+        self.assertEqual(("dir/hello.log", None), split_stream_ext("dir/hello.log"))
+        self.assertEqual(("dir/.gz", None), split_stream_ext("dir/.gz"))
+        self.assertEqual(("dir.gz/hello", None), split_stream_ext("dir.gz/hello"))
+        # no extension: not compressed, even if zlib-ng is available
+        name, cst = auto_compress_stream(pathlib.Path("hello"), "decompress", RawReadStream(b"hello"))
+        self.assertEqual("hello", str(name))
+        self.assertEqual(b"hello", cst.read_all())
+
+    def test_auto(self):
+        small = b"hello world\n" * 10
+        large = b"hello world\n" * 100000
+        name, cst = auto_compress_stream(pathlib.Path("hello.xz"), "auto", RawReadStream(small))
+        self.assertEqual("hello.xz", str(name))
+        with tempfile.TemporaryDirectory() as td:
+            small_file = pathlib.Path(td) / "small.log"
+            small_file.write_bytes(small)
+            name, cst = auto_compress_stream(small_file, "auto")
+            self.assertEqual(small_file, name)
+            self.assertEqual(small, cst.read_all())
+            large_file = pathlib.Path(td) / "large.log"
+            large_file.write_bytes(large)
+            # local output: not compressed
+            name, cst = auto_compress_stream(large_file, "auto")
+            self.assertEqual(large_file, name)
+            self.assertEqual(large_file, compressed_name(large_file, "auto", len(large)))
+            if "lz4" in stream_map:
+                name, cst = auto_compress_stream(large_file, "auto", remote=True)
+                self.assertEqual(str(large_file) + ".lz4", str(name))
+                self.assertEqual(name, compressed_name(large_file, "auto", len(large), remote=True))
+                _, dst = auto_compress_stream(pathlib.Path(name), "decompress", RawReadStream(cst.read_all()))
+                self.assertEqual(large, dst.read_all())
+
     def test_xz2gzip(self):
         data = b"hello world\n" * 1000
         xzdata = lzma.compress(data, lzma.FORMAT_XZ)
@@ -160,3 +391,135 @@ class TestS3Put(unittest.TestCase):
             ps = S3PutStream(rd, s3if, bucket="bucket123", key="key123", bufsize=1024)
             for _ in ps.gen():
                 pass
+
+    def test_s3put_compressed(self):
+        from unittest.mock import MagicMock
+        uploaded = []
+        s3if = MagicMock()
+        s3if.upload_fileobj.side_effect = lambda fp, *args, **kwargs: uploaded.append(fp.read())
+        rd = GzipCompressorStream(FileReadStream(self.tf, bufsize=1000))
+        ps = S3PutStream(rd, s3if, bucket="bucket123", key="key123")
+        for _ in ps.gen():
+            pass
+        self.tf.seek(0)
+        self.assertEqual(self.tf.read(), gzip.decompress(uploaded[0]))
+
+
+class TestS3RangedGet(unittest.TestCase):
+    def test_ranged_get(self):
+        from unittest.mock import MagicMock
+        from log2s3.compr_stream import S3RangedGetStream
+        data = bytes(range(256)) * 1000
+
+        def get_object(Bucket, Key, Range, IfMatch):
+            start, end = [int(x) for x in Range.removeprefix("bytes=").split("-")]
+            body = MagicMock()
+            body.read.return_value = data[start:end+1]
+            return {"Body": body}
+        s3if = MagicMock()
+        s3if.get_object.side_effect = get_object
+        st = S3RangedGetStream(s3if, "bucket123", "key123", len(data), "etag123", part_size=1000, concurrency=4)
+        self.assertEqual(data, st.read_all())
+        self.assertEqual(256, s3if.get_object.call_count)
+
+    def test_get_stream_unknown_size(self):
+        from unittest.mock import MagicMock, patch
+        from log2s3 import compr_stream
+        data = bytes(range(256)) * 1000
+
+        def get_object(Bucket, Key, Range, IfMatch=None):
+            body = MagicMock()
+            start, end = [int(x) for x in Range.removeprefix("bytes=").split("-")]
+            end = min(end, len(data) - 1)
+            body.read.return_value = data[start:end+1]
+            body.iter_chunks.return_value = [data[start:end+1]]
+            if IfMatch is None:
+                # first part: size is in ContentRange
+                self.assertEqual(0, start)
+                return {"Body": body, "ContentRange": f"bytes {start}-{end}/{len(data)}", "ETag": "etag123"}
+            self.assertEqual("etag123", IfMatch)
+            return {"Body": body}
+        s3if = MagicMock()
+        s3if.get_object.side_effect = get_object
+        with patch.object(compr_stream, "s3_ranged_part_size", 1000):
+            st = compr_stream.s3_get_stream(s3if, "bucket123", "key123")
+            self.assertIsInstance(st, compr_stream.S3RangedGetStream)
+            self.assertEqual(data, st.read_all())
+        # first request is reused: no GET of whole object
+        self.assertEqual(256, s3if.get_object.call_count)
+        # small object: whole object in the first response
+        s3if.reset_mock()
+        with patch.object(compr_stream, "s3_ranged_part_size", len(data)):
+            st = compr_stream.s3_get_stream(s3if, "bucket123", "key123")
+            self.assertIsInstance(st, compr_stream.S3GetStream)
+            self.assertEqual(data, st.read_all())
+        self.assertEqual(1, s3if.get_object.call_count)
+
+    def test_get_stream_empty(self):
+        from unittest.mock import MagicMock
+        from botocore.exceptions import ClientError
+        from log2s3 import compr_stream
+
+        def get_object(Bucket, Key, Range=None):
+            if Range is not None:
+                raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+            body = MagicMock()
+            body.iter_chunks.return_value = []
+            return {"Body": body, "ContentLength": 0}
+        s3if = MagicMock()
+        s3if.get_object.side_effect = get_object
+        st = compr_stream.s3_get_stream(s3if, "bucket123", "key123")
+        self.assertEqual(b"", st.read_all())
+
+
+class TestRead(unittest.TestCase):
+    input_data = bytes(range(256)) * 100
+
+    def test_read_part(self):
+        st = Stream(RawReadStream(self.input_data, 1000))
+        st.init_fp()
+        st.compact_size = 3000
+        res = []
+        while True:
+            d = st.read(777)
+            if len(d) == 0:
+                break
+            res.append(d)
+        self.assertEqual(self.input_data, b"".join(res))
+        self.assertEqual([777] * (len(self.input_data) // 777), [len(x) for x in res[:-1]])
+
+    def test_read_all(self):
+        st = Stream(RawReadStream(self.input_data, 1000))
+        st.init_fp()
+        self.assertEqual(self.input_data[:10], st.read(10))
+        self.assertEqual(self.input_data[10:], st.read())
+        self.assertEqual(b"", st.read())
+
+
+class TestPrefetch(unittest.TestCase):
+    input_data = bytes(range(256)) * 100
+
+    def test_prefetch(self):
+        st = PrefetchStream(RawReadStream(self.input_data, 1000))
+        self.assertEqual(self.input_data, st.read_all())
+
+    def test_close(self):
+        gen = PrefetchStream(RawReadStream(self.input_data, 10), 1).gen()
+        self.assertEqual(self.input_data[:10], next(gen))
+        gen.close()
+
+    def test_error(self):
+        class ErrorStream(Stream):
+            def gen(self):
+                yield b"hello"
+                raise ValueError("broken")
+        with self.assertRaises(ValueError):
+            PrefetchStream(ErrorStream(None)).read_all()
+
+
+class TestMerge(unittest.TestCase):
+    def test_merge(self):
+        st1 = RawReadStream(b"a\nc\ne\n", 3)
+        st2 = RawReadStream(b"b\nd\n", 3)
+        st3 = RawReadStream(b"", 3)
+        self.assertEqual(["a\n", "b\n", "c\n", "d\n", "e\n"], list(MergeStream([st1, st2, st3]).text_gen()))